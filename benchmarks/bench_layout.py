@@ -0,0 +1,62 @@
+# ========================================================
+# benchmark: memory and write-back cost of the first-level pool layouts
+# --------------------------------------------------------
+# usage: python benchmarks/bench_layout.py --db 15 --size 200000
+# memory is the growth of used_memory(INFO memory) after inserting --size
+# proxies, scaled to one million proxies.
+# WARNING: the given db is flushed before each run.
+# ========================================================
+import time
+import random
+import argparse
+from nproxypool.base.db import RedisPool
+
+
+def make_proxies(size):
+    return ['10.{}.{}.{}:8080'.format(i >> 16 & 255, i >> 8 & 255, i & 255) for i in range(size)]
+
+
+def used_memory(pool):
+    return pool._client.info('memory')['used_memory']
+
+
+def measure(layout, args):
+    pool = RedisPool(host=args.host, port=args.port, password=args.password, db=args.db, layout=layout)
+    proxies = make_proxies(args.size)
+    pool._client.flushdb()
+    before = used_memory(pool)
+    pool.insert_many(proxies, chunk_size=args.chunk_size, source='bench')
+    per_proxy = (used_memory(pool) - before) / args.size
+    sample = random.sample(proxies, min(100, args.size))
+    usage = sum(pool._client.memory_usage(p) or 0 for p in sample) / len(sample)
+
+    successes = random.sample(proxies, args.size // 3)
+    failures = list(set(proxies) - set(successes))
+    latencies = {p: random.randint(50, 3000) for p in successes}
+    start = time.monotonic()
+    pool.update_many(successes, failures, chunk_size=args.chunk_size, latencies=latencies)
+    wall = time.monotonic() - start
+    # bytes per proxy is also MB(10^6 bytes) per million proxies
+    print('{:<8} bytes/proxy: {:>7.1f}  MEMORY USAGE: {:>6.1f}  round write-back: {:>7.3f}s'.format(
+        layout, per_proxy, usage, wall
+    ))
+    return per_proxy
+
+
+def main():
+    parser = argparse.ArgumentParser(description='first-level pool layout benchmark')
+    parser.add_argument('--host', default='localhost')
+    parser.add_argument('--port', type=int, default=6379)
+    parser.add_argument('--password', default='')
+    parser.add_argument('--db', type=int, default=15)
+    parser.add_argument('--size', type=int, default=200000)
+    parser.add_argument('--chunk-size', type=int, default=500)
+    args = parser.parse_args()
+
+    string = measure('string', args)
+    packed = measure('packed', args)
+    print('packed saves {:.1f} MB per million proxies'.format(string - packed))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,83 @@
+# ========================================================
+# benchmark: random proxy checkout latency and throughput against pool size
+# --------------------------------------------------------
+# usage: python benchmarks/bench_random.py --db 15 --sizes 1000,10000,100000
+# WARNING: the given db is flushed before each run.
+# ========================================================
+import time
+import random
+import argparse
+from nproxypool.base import server
+from nproxypool.base.db import RedisPool
+from nproxypool.utils.exceptions import PoolEmptyException
+
+
+def legacy_random_get_one(pool, key):
+    res = pool._client.zrangebyscore(key, 100, 100)
+    if not res:
+        res = pool._client.zrangebyscore(key, 85, 100)
+    if res:
+        proxy = pool._bytes_to_str(random.choice(res))
+        pool.z_decrease(proxy, key, to_decr=1)
+        return proxy
+    raise PoolEmptyException()
+
+
+def populate(pool, key, size, top_ratio):
+    pool._client.flushdb()
+    pipe = pool._client.pipeline(transaction=False)
+    for i in range(size):
+        proxy = '10.{}.{}.{}:8080'.format(i >> 16 & 255, i >> 8 & 255, i & 255)
+        score = 100 if random.random() < top_ratio else random.randint(31, 99)
+        pipe.zadd(key, {proxy: score})
+        if i % 10000 == 0:
+            pipe.execute()
+    pipe.execute()
+
+
+def percentile(samples, p):
+    samples = sorted(samples)
+    return samples[min(len(samples) - 1, int(len(samples) * p))]
+
+
+def measure(name, size, func, requests):
+    samples = []
+    start = time.monotonic()
+    for _ in range(requests):
+        _start = time.monotonic()
+        func()
+        samples.append(time.monotonic() - _start)
+    wall = time.monotonic() - start
+    print('{:<10} size: {:>8}  p50: {:>7.3f}ms  p99: {:>7.3f}ms  throughput: {:>8.0f}/s'.format(
+        name, size, percentile(samples, 0.5) * 1000, percentile(samples, 0.99) * 1000, requests / wall
+    ))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='random checkout benchmark')
+    parser.add_argument('--host', default='localhost')
+    parser.add_argument('--port', type=int, default=6379)
+    parser.add_argument('--password', default='')
+    parser.add_argument('--db', type=int, default=15)
+    parser.add_argument('--sizes', default='1000,10000,100000')
+    parser.add_argument('--top-ratio', type=float, default=0.3)
+    parser.add_argument('--requests', type=int, default=2000)
+    args = parser.parse_args()
+
+    key = 'bench'
+    pool = RedisPool(host=args.host, port=args.port, password=args.password, db=args.db)
+    server.POOL = pool
+    client = server.create_app().test_client()
+    cases = (
+        ('legacy', lambda: legacy_random_get_one(pool, key)),
+        ('lua', lambda: pool.z_random_get_one(key)),
+        ('http', lambda: client.get('/proxy/random/', query_string={'key': key})),
+    )
+    for size in [int(i) for i in args.sizes.split(',')]:
+        for name, func in cases:
+            populate(pool, key, size, args.top_ratio)
+            measure(name, size, func, args.requests)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,81 @@
+# ========================================================
+# benchmark: synchronizer pass over synthetic pools
+# --------------------------------------------------------
+# usage: python benchmarks/bench_sync.py --first-db 14 --second-db 15 --sizes 10000,100000,1000000
+# WARNING: both dbs are flushed before each run.
+# ========================================================
+import time
+import argparse
+from nproxypool.base.db import RedisPool
+from nproxypool.base.synchronizer import Synchronizer
+
+
+def proxy_name(i):
+    return '{}.{}.{}.{}:8080'.format(i >> 24 & 255, i >> 16 & 255, i >> 8 & 255, i & 255)
+
+
+def populate(first, second, key, size, stale_ratio):
+    """
+    first-level pool holds `size` proxies, the zset holds the same proxies
+    plus `size * stale_ratio` proxies missing from first-level pool.
+    """
+    first._client.flushdb()
+    second._client.flushdb()
+    expire_stamp = int(time.time() + 3600)
+    pipe1 = first._client.pipeline(transaction=False)
+    pipe2 = second._client.pipeline(transaction=False)
+    for i in range(size + int(size * stale_ratio)):
+        proxy = proxy_name(i)
+        if i < size:
+            pipe1.set(proxy, '{};{}'.format(expire_stamp, 60))
+            pipe1.expireat(proxy, expire_stamp)
+        pipe2.zadd(key, {proxy: 100})
+        if i % 10000 == 0:
+            pipe1.execute()
+            pipe2.execute()
+    pipe1.execute()
+    pipe2.execute()
+
+
+def legacy_synchronize(first, second, keys):
+    first_level_pool_proxies = first._client.keys()
+    for key in keys:
+        for proxy in second.z_get_all(key):
+            if proxy not in first_level_pool_proxies:
+                second.z_delete(proxy, key)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='synchronizer benchmark')
+    parser.add_argument('--host', default='localhost')
+    parser.add_argument('--port', type=int, default=6379)
+    parser.add_argument('--password', default='')
+    parser.add_argument('--first-db', type=int, default=14)
+    parser.add_argument('--second-db', type=int, default=15)
+    parser.add_argument('--sizes', default='10000,100000,1000000')
+    parser.add_argument('--stale-ratio', type=float, default=0.1)
+    parser.add_argument('--legacy-max-size', type=int, default=20000,
+                        help='the legacy pass is O(first x second), skip it above this size')
+    args = parser.parse_args()
+
+    key = 'bench'
+    params = dict(host=args.host, port=args.port, password=args.password)
+    first = RedisPool(db=args.first_db, **params)
+    second = RedisPool(db=args.second_db, **params)
+    kwargs = dict(first_db=args.first_db, second_db=args.second_db, second_db_keys=[key], **params)
+    for size in [int(i) for i in args.sizes.split(',')]:
+        cases = [('set+chunked zrem', lambda: Synchronizer().synchronize(**kwargs))]
+        if size <= args.legacy_max_size:
+            cases.insert(0, ('legacy', lambda: legacy_synchronize(first, second, [key])))
+        for name, func in cases:
+            populate(first, second, key, size, args.stale_ratio)
+            start = time.monotonic()
+            func()
+            wall = time.monotonic() - start
+            print('{:<18} size: {:>8}  wall: {:>8.3f}s  left in zset: {}'.format(
+                name, size, wall, second._client.zcard(key)
+            ))
+
+
+if __name__ == '__main__':
+    main()
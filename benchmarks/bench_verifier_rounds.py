@@ -0,0 +1,65 @@
+# ========================================================
+# benchmark: fixed cost of a verifier round
+# --------------------------------------------------------
+# usage: python benchmarks/bench_verifier_rounds.py --db 15 --rounds 50
+# compares a new Verifier per round(new loop, session and redis connections)
+# with one long-lived Verifier running all the rounds, on a small pool of
+# loopback proxies so the rounds are dominated by their fixed cost.
+# WARNING: the given db is flushed.
+# ========================================================
+import time
+import logging
+import argparse
+from nproxypool.base.db import RedisPool
+from nproxypool.base.verifier import Verifier
+from nproxypool.bench.farm import ProxyFarm
+
+
+def per_round(rounds, run_round):
+    times = []
+    for _ in range(rounds):
+        start = time.monotonic()
+        run_round()
+        times.append(time.monotonic() - start)
+    times.sort()
+    return sum(times) / len(times), times[len(times) // 2]
+
+
+def main():
+    parser = argparse.ArgumentParser(description='verifier round overhead benchmark')
+    parser.add_argument('--host', default='localhost')
+    parser.add_argument('--port', type=int, default=6379)
+    parser.add_argument('--password', default='')
+    parser.add_argument('--db', type=int, default=15)
+    parser.add_argument('--proxies', type=int, default=10)
+    parser.add_argument('--rounds', type=int, default=50)
+    args = parser.parse_args()
+
+    farm = ProxyFarm(proxies=args.proxies, latency=0, failure_rate=0, dead_rate=0).start()
+    pool = RedisPool(host=args.host, port=args.port, password=args.password, db=args.db)
+    pool._client.flushdb()
+    pool.insert_many(farm.proxies)
+    logger = logging.getLogger('bench_verifier_rounds')
+    logger.setLevel(logging.WARNING)
+    kwargs = dict(host=args.host, port=args.port, password=args.password, from_db=args.db, to_db=args.db,
+                  url=farm.target_url, max_worker=args.proxies)
+
+    def fresh_round():
+        v = Verifier()
+        v._logger = logger
+        v.run(**kwargs)
+
+    v = Verifier()
+    v._logger = logger
+    v.start(**kwargs)
+    try:
+        for name, run_round in (('per-round', fresh_round), ('long-lived', v.run_round)):
+            mean, p50 = per_round(args.rounds, run_round)
+            print('{:<10} mean: {:>7.2f}ms  p50: {:>7.2f}ms'.format(name, mean * 1000, p50 * 1000))
+    finally:
+        v.close()
+        farm.stop()
+
+
+if __name__ == '__main__':
+    main()
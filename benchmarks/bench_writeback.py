@@ -0,0 +1,105 @@
+# ========================================================
+# benchmark: per-proxy vs batched write-back of a verifier round
+# --------------------------------------------------------
+# usage: python benchmarks/bench_writeback.py --db 15 --size 20000
+# WARNING: the given db is flushed before each run.
+# ========================================================
+import time
+import random
+import argparse
+from nproxypool.base.db import RedisPool
+
+
+def count_round_trips(pool):
+    counter = {'n': 0}
+    execute_command = pool._client.execute_command
+
+    def _execute_command(*args, **kwargs):
+        counter['n'] += 1
+        return execute_command(*args, **kwargs)
+
+    pool._client.execute_command = _execute_command
+    return counter
+
+
+def make_round(size, success_ratio):
+    proxies = ['10.{}.{}.{}:8080'.format(i >> 16 & 255, i >> 8 & 255, i & 255) for i in range(size)]
+    successes, failures = [], []
+    for proxy in proxies:
+        (successes if random.random() < success_ratio else failures).append(proxy)
+    return proxies, successes, failures
+
+
+def populate(pool, proxies, zset_key):
+    pool._client.flushdb()
+    pipe = pool._client.pipeline(transaction=False)
+    expire_stamp = int(time.time() + 600)
+    for proxy in proxies:
+        pipe.set(proxy, '{};{}'.format(expire_stamp, 60))
+        pipe.expireat(proxy, expire_stamp)
+        pipe.zadd(zset_key, {proxy: 100})
+    pipe.execute()
+
+
+def legacy_key_update(pool, successes, failures, score_threshold=30, to_decr=30):
+    for proxy in failures:
+        value = pool.get_one(proxy)
+        if value:
+            _, score = value.split(';')
+            new_score = int(score) - to_decr
+            if new_score <= score_threshold:
+                pool.delete_one(proxy)
+            else:
+                pool.update_one(proxy, new_score, old_value=value)
+    for proxy in successes:
+        value = pool.get_one(proxy)
+        if value:
+            pool.update_one(proxy, score=100, old_value=value)
+        else:
+            pool.insert_one(proxy, score=60)
+
+
+def legacy_zset_update(pool, key, successes, failures, score_threshold=30, to_decr=30):
+    for proxy in failures:
+        pool.z_decrease(proxy, key, score_threshold=score_threshold, to_decr=to_decr)
+    for proxy in successes:
+        pool.z_increase(proxy, key)
+
+
+def measure(name, pool, func, *args, **kwargs):
+    counter = count_round_trips(pool)
+    start = time.monotonic()
+    func(*args, **kwargs)
+    wall = time.monotonic() - start
+    print('{:<24} round_trips: {:>8}  wall: {:>8.3f}s'.format(name, counter['n'], wall))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='verifier write-back benchmark')
+    parser.add_argument('--host', default='localhost')
+    parser.add_argument('--port', type=int, default=6379)
+    parser.add_argument('--password', default='')
+    parser.add_argument('--db', type=int, default=15)
+    parser.add_argument('--size', type=int, default=20000)
+    parser.add_argument('--success-ratio', type=float, default=0.3)
+    parser.add_argument('--chunk-size', type=int, default=500)
+    args = parser.parse_args()
+
+    key = 'bench'
+    proxies, successes, failures = make_round(args.size, args.success_ratio)
+    print('proxies: {}, successes: {}, failures: {}'.format(len(proxies), len(successes), len(failures)))
+
+    cases = (
+        ('key legacy', legacy_key_update, (successes, failures), {}),
+        ('key batched', RedisPool.update_many, (successes, failures), {'chunk_size': args.chunk_size}),
+        ('zset legacy', legacy_zset_update, (key, successes, failures), {}),
+        ('zset batched', RedisPool.z_update_many, (key, successes, failures), {'chunk_size': args.chunk_size}),
+    )
+    for name, func, func_args, func_kwargs in cases:
+        pool = RedisPool(host=args.host, port=args.port, password=args.password, db=args.db)
+        populate(pool, proxies, key)
+        measure(name, pool, func, pool, *func_args, **func_kwargs)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,484 @@
+# Async Redis Client to Save IPs
+# -----------------------------------------
+# mirrors every operation of RedisPoolBase and RedisPool on redis.asyncio,
+# so the verifier, the fetchers and an async server never block their event
+# loop on Redis. Operations applied in chunks(update_many, z_update_many, ...)
+# queue all the script calls of the chunks into one pipeline, a whole batch of
+# results being written in a single round trip.
+# see db.py for the layouts and the scripts.
+# -----------------------------------------
+import time
+from random import randint
+from redis.asyncio import ConnectionPool, StrictRedis
+from nproxypool.base.db import KEY_UPDATE_SCRIPT, PACKED_UPDATE_SCRIPT, MIGRATE_SCRIPT, SCHEDULE_SCRIPT
+from nproxypool.base.db import ZSET_UPDATE_SCRIPT, Z_CHECKOUT_SCRIPT, Z_CHECKOUT_MANY_SCRIPT, Z_DECREASE_SCRIPT
+from nproxypool.base.db import LATENCY_UPDATE_SCRIPT, PACKED_RECORD
+from nproxypool.base.db import META_PREFIX, VERSION_KEY, DUE_PREFIX, STREAK_PREFIX, LATENCY_PREFIX
+from nproxypool.base.db import SOURCES_KEY, SOURCES_SEQ_FIELD, REDIS_ROUND_TRIPS
+from nproxypool.base.db import _chunks, _current_op, _instrument, _untimed
+from nproxypool.base import metrics
+from nproxypool.base.metrics import METRICS_KEY
+from nproxypool.utils.exceptions import PoolEmptyException
+
+
+class CountingRedis(StrictRedis):
+    """
+    async twin of db.CountingRedis, counts round trips under the pool operation running.
+    """
+    async def execute_command(self, *args, **options):
+        if metrics.INSTRUMENTED:
+            REDIS_ROUND_TRIPS.inc(op=_current_op.get())
+        return await super(CountingRedis, self).execute_command(*args, **options)
+
+    def pipeline(self, transaction=True, shard_hint=None):
+        pipe = super(CountingRedis, self).pipeline(transaction, shard_hint)
+        execute = pipe.execute
+
+        async def _execute(*args, **kwargs):
+            if pipe.command_stack and metrics.INSTRUMENTED:
+                REDIS_ROUND_TRIPS.inc(op=_current_op.get())
+            return await execute(*args, **kwargs)
+
+        pipe.execute = _execute
+        return pipe
+
+
+@_instrument
+class AsyncRedisPoolBase(object):
+    def __init__(self, **kwargs):
+        """
+        max_connections: size of the connection pool, unlimited by default
+        """
+        self._kwargs = kwargs
+        self._redis_uri = "redis://:{password}@{host}:{port}/{db}"
+        self._client = None
+        self._get_client()
+        self._value_pattern = '{};{}'
+        self._layout = kwargs.get('layout', 'string')
+        self._source_ids = {}
+        self._key_update_script = self._client.register_script(KEY_UPDATE_SCRIPT)
+        self._packed_update_script = self._client.register_script(PACKED_UPDATE_SCRIPT)
+        self._migrate_script = self._client.register_script(MIGRATE_SCRIPT)
+        self._schedule_script = self._client.register_script(SCHEDULE_SCRIPT)
+
+    def _get_client(self):
+        if not self._kwargs.get('uri'):
+            password = self._kwargs.get('password', '')
+            host = self._kwargs.get('host', 'localhost')
+            port = self._kwargs.get('port', '6379')
+            db = self._kwargs.get('db', 1)
+            redis_uri = self._redis_uri.format(
+                password=password,
+                host=host,
+                port=port,
+                db=db
+            )
+        else:
+            redis_uri = self._kwargs['uri']
+        pool = ConnectionPool.from_url(
+            redis_uri,
+            max_connections=self._kwargs.get('max_connections')
+        )
+        self._client = CountingRedis(connection_pool=pool)
+
+    async def close(self):
+        await self._client.connection_pool.disconnect()
+
+    @staticmethod
+    def _bytes_to_str(_value):
+        res = _value
+        if isinstance(_value, bytes):
+            res = str(_value, encoding="utf-8")
+        return res
+
+    # ====================================
+    #  first-level pool operations
+    # ====================================
+    @_untimed
+    def iter_all(self, count=1000):
+        """
+        async iterator of the proxies in first-level pool, with SCAN.
+        count: hint of keys to fetch per SCAN call
+        """
+        return self._scan_iter(count)
+
+    async def _scan_iter(self, count):
+        prefix = META_PREFIX.encode()
+        async for key in self._client.scan_iter(count=count):
+            if not key.startswith(prefix):
+                yield key
+
+    async def get_all(self, count=1000):
+        return list(dict.fromkeys([key async for key in self.iter_all(count=count)]))
+
+    async def get_one(self, key):
+        """
+        return: '{expire};{score}' whatever the layout, None if not in the pool
+        """
+        if self._layout != 'packed':
+            r = await self._client.get(key)
+            return r if not r else self._bytes_to_str(r)
+        record = await self.get_record(key)
+        return record and self._value_pattern.format(record['expire'], record['score'])
+
+    async def get_record(self, key):
+        """
+        return: dict of score, expire, fails, latency(ms) and source, None if not in the pool.
+        """
+        pipe = self._client.pipeline(transaction=False)
+        pipe.get(key)
+        pipe.ttl(key)
+        value, ttl = await pipe.execute()
+        if not value:
+            return None
+        expire = int(time.time()) + max(ttl, 0)
+        if len(value) != PACKED_RECORD.size:
+            _, score = self._bytes_to_str(value).split(';')
+            return {'score': int(float(score)), 'expire': expire, 'fails': None, 'latency': None, 'source': None}
+        score, fails, latency, source_id = PACKED_RECORD.unpack(value)
+        return {
+            'score': score,
+            'expire': expire,
+            'fails': fails,
+            'latency': latency,
+            'source': await self._source_name(source_id)
+        }
+
+    async def _source_id(self, source):
+        if not source:
+            return 0
+        if source not in self._source_ids:
+            source_id = await self._client.hget(SOURCES_KEY, source)
+            if source_id is None:
+                seq = await self._client.hincrby(SOURCES_KEY, SOURCES_SEQ_FIELD, 1)
+                await self._client.hsetnx(SOURCES_KEY, source, seq)
+                source_id = await self._client.hget(SOURCES_KEY, source)
+            self._source_ids[source] = int(source_id) % 65536
+        return self._source_ids[source]
+
+    async def _source_name(self, source_id):
+        if not source_id:
+            return None
+        for name, _id in (await self._client.hgetall(SOURCES_KEY)).items():
+            name = self._bytes_to_str(name)
+            if name != SOURCES_SEQ_FIELD and int(_id) == source_id:
+                return name
+        return None
+
+    async def insert_one(self, key, score=60, expire=600):
+        await self.insert_many([key], score=score, expire=expire)
+
+    async def insert_many(self, proxies, score=60, expire=600, chunk_size=500, source=''):
+        """
+        same as RedisPoolBase.insert_many, the SET NX of each chunk in one pipeline.
+        return: {'proxies': number given, 'new': number inserted, 'duplicates': the others}
+        """
+        proxies = list(proxies)
+        unique = list(dict.fromkeys(self._bytes_to_str(p) for p in proxies))
+        if self._layout == 'packed':
+            value = PACKED_RECORD.pack(min(max(score, 0), 255), 0, 0, await self._source_id(source))
+        inserted = 0
+        for chunk in _chunks(unique, chunk_size):
+            if self._layout != 'packed':
+                value = self._value_pattern.format(int(time.time() + expire), score)
+            pipe = self._client.pipeline(transaction=False)
+            for proxy in chunk:
+                pipe.set(proxy, value, ex=expire, nx=True)
+            inserted += sum(1 for res in await pipe.execute() if res)
+        return {'proxies': len(proxies), 'new': inserted, 'duplicates': len(proxies) - inserted}
+
+    async def update_one(self, key, score=60, old_value=''):
+        """
+        update score but never change the expire time.
+        """
+        if self._layout == 'packed':
+            if await self._client.exists(key):
+                await self._client.setrange(key, 0, bytes([min(max(score, 0), 255)]))
+            return
+        old_value = old_value or await self.get_one(key)
+        _expire = old_value.split(';')[0]
+        expire_stamp = int(_expire) if _expire else int(time.time() - 300)
+        pipe = self._client.pipeline(transaction=False)
+        pipe.set(key, self._value_pattern.format(expire_stamp, score))
+        pipe.expireat(key, expire_stamp)
+        await pipe.execute()
+
+    async def delete_one(self, key):
+        await self._client.delete(key)
+
+    async def enable_key_events(self, flags='Egx'):
+        current = (await self._client.config_get('notify-keyspace-events')).get('notify-keyspace-events', '')
+        merged = ''.join(sorted(set(self._bytes_to_str(current)) | set(flags)))
+        await self._client.config_set('notify-keyspace-events', merged)
+
+    async def subscribe_key_events(self, events=('expired', 'del')):
+        """
+        return: an async pubsub subscribed to the given keyevents of this db
+        """
+        db = self._client.connection_pool.connection_kwargs.get('db', 0)
+        pubsub = self._client.pubsub(ignore_subscribe_messages=True)
+        await pubsub.subscribe(*['__keyevent@{}__:{}'.format(db, e) for e in events])
+        return pubsub
+
+    async def update_many(self, successes, failures, score_threshold=30, to_decr=30, chunk_size=500, latencies=None):
+        """
+        same as RedisPoolBase.update_many, the script calls of all chunks in one pipeline.
+        """
+        results = [(p, '0') for p in failures] + [(p, '1') for p in successes]
+        if not results:
+            return
+        latencies = latencies or {}
+        pipe = self._client.pipeline(transaction=False)
+        for chunk in _chunks(results, chunk_size):
+            keys = [p for p, _ in chunk]
+            if self._layout == 'packed':
+                args = [score_threshold, to_decr, 60, 600, 100]
+                for proxy, flag in chunk:
+                    args.extend((flag, latencies.get(proxy, 0)))
+                await self._packed_update_script(keys=keys, args=args, client=pipe)
+            else:
+                args = [int(time.time()), score_threshold, to_decr, 60, 600, 100]
+                args.extend(flag for _, flag in chunk)
+                await self._key_update_script(keys=keys, args=args, client=pipe)
+        await pipe.execute()
+
+    async def migrate_layout(self, layout, count=1000, chunk_size=500):
+        """
+        return: number of records converted
+        """
+        migrated = 0
+        chunk = []
+        async for key in self._scan_iter(count):
+            chunk.append(key)
+            if len(chunk) >= chunk_size:
+                migrated += await self._migrate_script(keys=chunk, args=[layout, int(time.time())])
+                chunk = []
+        if chunk:
+            migrated += await self._migrate_script(keys=chunk, args=[layout, int(time.time())])
+        self._layout = layout
+        return migrated
+
+    # ====================================
+    #  re-verification schedule
+    # ====================================
+    async def filter_due(self, name, proxies, now=None):
+        if not proxies:
+            return []
+        now = time.time() if now is None else now
+        pipe = self._client.pipeline(transaction=False)
+        for proxy in proxies:
+            pipe.zscore(DUE_PREFIX + name, proxy)
+        return [p for p, due in zip(proxies, await pipe.execute()) if due is None or due <= now]
+
+    async def schedule_many(self, name, successes, failures, min_interval=60, max_interval=1800, chunk_size=500):
+        results = [(p, '0') for p in failures] + [(p, '1') for p in successes]
+        if not results:
+            return
+        pipe = self._client.pipeline(transaction=False)
+        for chunk in _chunks(results, chunk_size):
+            args = [randint(0, 2 ** 31 - 1), time.time(), min_interval, max_interval]
+            for proxy, flag in chunk:
+                args.extend((proxy, flag))
+            await self._schedule_script(keys=[DUE_PREFIX + name, STREAK_PREFIX + name], args=args, client=pipe)
+        await pipe.execute()
+
+
+@_instrument
+class AsyncRedisPool(AsyncRedisPoolBase):
+    def __init__(self, **kwargs):
+        super(AsyncRedisPool, self).__init__(**kwargs)
+        self._zset_update_script = self._client.register_script(ZSET_UPDATE_SCRIPT)
+        self._z_decrease_script = self._client.register_script(Z_DECREASE_SCRIPT)
+        self._z_checkout_script = self._client.register_script(Z_CHECKOUT_SCRIPT)
+        self._z_checkout_many_script = self._client.register_script(Z_CHECKOUT_MANY_SCRIPT)
+        self._latency_update_script = self._client.register_script(LATENCY_UPDATE_SCRIPT)
+
+    # ====================================
+    #  second-level pool(zset) operations
+    # ====================================
+    @_untimed
+    def z_iter_all_keys(self, count=1000):
+        return self._scan_iter(count)
+
+    async def z_get_all_keys(self, count=1000):
+        return list(dict.fromkeys([key async for key in self.z_iter_all_keys(count=count)]))
+
+    async def z_exists(self, key):
+        """
+        metadata keys(META_PREFIX) are not zsets of proxies and never exist as such.
+        """
+        return not key.startswith(META_PREFIX) and bool(await self._client.exists(key))
+
+    async def z_iter(self, key, count=1000):
+        """
+        async iterator of the proxies in a zset, with ZSCAN
+        """
+        async for proxy, _ in self._client.zscan_iter(key, count=count):
+            yield proxy
+
+    async def z_get_all(self, key):
+        return await self._client.zrangebyscore(key, -60, 100)
+
+    async def z_get(self, proxy, key):
+        return await self._client.zscore(key, proxy)
+
+    async def z_add(self, proxy, key, score):
+        await self._client.zadd(key, {proxy: score}, nx=True)
+
+    async def z_increase(self, proxy, key):
+        await self._client.zadd(key, {proxy: 100})
+
+    async def z_delete(self, proxy, key):
+        await self.z_delete_many(key, [proxy])
+
+    async def z_delete_many(self, key, proxies):
+        """
+        return: number of proxies removed
+        """
+        if not proxies:
+            return 0
+        pipe = self._client.pipeline(transaction=False)
+        pipe.zrem(key, *proxies)
+        pipe.hdel(LATENCY_PREFIX + key, *proxies)
+        return (await pipe.execute())[0]
+
+    async def z_delete_from_keys(self, keys, proxies):
+        """
+        return: dict of key -> number of proxies removed
+        """
+        if not proxies or not keys:
+            return {}
+        pipe = self._client.pipeline(transaction=False)
+        for key in keys:
+            pipe.zrem(key, *proxies)
+            pipe.hdel(LATENCY_PREFIX + key, *proxies)
+        removed = dict(zip(keys, (await pipe.execute())[::2]))
+        for key, num in removed.items():
+            if num:
+                pipe.hincrby(VERSION_KEY, key, 1)
+        await pipe.execute()
+        return removed
+
+    async def z_decrease(self, proxy, key, score_threshold=20, to_decr=30):
+        await self.z_decrease_many(key, {proxy: to_decr}, score_threshold=score_threshold)
+
+    async def z_update_many(self, key, successes, failures, score_threshold=30, to_decr=30, chunk_size=500):
+        """
+        same as RedisPool.z_update_many, the script calls of all chunks in one pipeline.
+        """
+        results = [(p, '0') for p in failures] + [(p, '1') for p in successes]
+        if not results:
+            return
+        pipe = self._client.pipeline(transaction=False)
+        for chunk in _chunks(results, chunk_size):
+            args = [score_threshold, to_decr, 100, 85]
+            for proxy, flag in chunk:
+                args.extend((proxy, flag))
+            await self._zset_update_script(keys=[key, VERSION_KEY, LATENCY_PREFIX + key], args=args, client=pipe)
+        await pipe.execute()
+
+    async def z_decrease_many(self, key, usage, score_threshold=20, chunk_size=500):
+        """
+        usage: dict of proxy -> score to decrease by, proxies no longer in the zset are skipped
+        """
+        items = list(usage.items())
+        if not items:
+            return
+        pipe = self._client.pipeline(transaction=False)
+        for chunk in _chunks(items, chunk_size):
+            args = [score_threshold]
+            for proxy, amount in chunk:
+                args.extend((proxy, amount))
+            await self._z_decrease_script(keys=[key, LATENCY_PREFIX + key], args=args, client=pipe)
+        await pipe.execute()
+
+    async def z_get_version(self, key):
+        return int(await self._client.hget(VERSION_KEY, key) or 0)
+
+    async def z_bump_version(self, key):
+        await self._client.hincrby(VERSION_KEY, key, 1)
+
+    async def z_get_tier(self, key, min_score=85, max_score=100):
+        """
+        get the version of a zset and its proxies scored in [min_score, max_score] in one round trip.
+        return: version, [(proxy, score), ...]
+        """
+        pipe = self._client.pipeline(transaction=False)
+        pipe.hget(VERSION_KEY, key)
+        pipe.zrangebyscore(key, min_score, max_score, withscores=True)
+        version, members = await pipe.execute()
+        return int(version or 0), [(self._bytes_to_str(p), s) for p, s in members]
+
+    async def z_random_get_one(self, key='baidu'):
+        """
+        pick a random proxy scored 100(or 85-100 if none) and decrease it by 1,
+        in a single round trip.
+        """
+        proxy = await self._z_checkout_script(
+            keys=[key, LATENCY_PREFIX + key],
+            args=[randint(0, 2 ** 31 - 1), 100, 85, 100, 1, 20]
+        )
+        if not proxy:
+            raise PoolEmptyException()
+        return self._bytes_to_str(proxy)
+
+    async def z_random_get_many(self, key='baidu', n=1, weight=''):
+        """
+        pick n distinct proxies from the top tier and decrease each by 1, in a single round trip.
+        weight: '' for uniform, 'score' to prefer higher scores, 'latency' to prefer faster proxies
+        """
+        proxies = await self._z_checkout_many_script(
+            keys=[key, LATENCY_PREFIX + key],
+            args=[randint(0, 2 ** 31 - 1), 100, 85, 100, 1, 20, n, weight]
+        )
+        if not proxies:
+            raise PoolEmptyException()
+        return [self._bytes_to_str(i) for i in proxies]
+
+    async def z_update_latency(self, key, latencies, failures=(), alpha=0.3, window=20, chunk_size=500):
+        """
+        latencies: dict of proxy -> latency in ms of a successful probe
+        failures: proxies whose latency is forgotten
+        """
+        items = list(latencies.items()) + [(p, '') for p in failures]
+        if not items:
+            return
+        pipe = self._client.pipeline(transaction=False)
+        for chunk in _chunks(items, chunk_size):
+            args = [alpha, window]
+            for proxy, ms in chunk:
+                args.extend((proxy, ms))
+            await self._latency_update_script(keys=[LATENCY_PREFIX + key], args=args, client=pipe)
+        await pipe.execute()
+
+    async def z_get_latency(self, key, proxy):
+        """
+        return: (ewma, p95) in ms, or None if the proxy has no successful probe recorded
+        """
+        value = await self._client.hget(LATENCY_PREFIX + key, proxy)
+        if not value:
+            return None
+        ewma, p95, _ = self._bytes_to_str(value).split(';', 2)
+        return int(ewma), int(p95)
+
+    async def z_get_total_num(self, key, min_score=0, max_score=100, get_list=False):
+        if not get_list:
+            return await self._client.zcount(key, min_score, max_score)
+        res = await self._client.zrangebyscore(key, min_score, max_score)
+        return [self._bytes_to_str(i) for i in res]
+
+    # ====================================
+    #  metrics of all processes
+    # ====================================
+    async def push_metrics(self, field, value):
+        await self._client.hset(METRICS_KEY, field, value)
+
+    async def get_metrics(self):
+        """
+        return: dict of process id -> pushed json
+        """
+        return {self._bytes_to_str(k): v for k, v in (await self._client.hgetall(METRICS_KEY)).items()}
+
+    async def delete_metrics(self, fields):
+        if fields:
+            await self._client.hdel(METRICS_KEY, *fields)
@@ -0,0 +1,209 @@
+# =============================================
+# async(ASGI) server for the proxypool,
+# serves the same endpoints as server.py
+# ==============================================
+import time
+import asyncio
+import traceback
+from contextlib import asynccontextmanager
+from starlette.applications import Starlette
+from starlette.responses import JSONResponse, Response
+from starlette.routing import Route
+from nproxypool.base.aio_db import AsyncRedisPool
+from nproxypool.base.db import META_PREFIX
+from nproxypool.base.cache import AsyncHotCache
+from nproxypool.base import metrics
+from nproxypool.utils.exceptions import PoolEmptyException
+from nproxypool.utils.misc import get_sychronizer_config, get_redis_config, get_server_config
+from nproxypool.utils.misc import get_metrics_config
+
+
+POOL = None
+CACHE = None
+MAX_BATCH = 100
+METRICS = None
+PUSHER = None
+# second-level keys of pool.cfg, the only ones used as metric labels
+KEYS = frozenset()
+ENDPOINTS = ('/proxy/random/', '/proxy/total/', '/proxy/list/', '/metrics')
+
+
+def get_second_level_pool(dir):
+    synch_config = get_sychronizer_config(dir)
+    redis_config = get_redis_config(dir)
+    redis_config['db'] = synch_config['second_db']
+    server_config = get_server_config(dir)
+    redis_config['max_connections'] = server_config['max_connections']
+    global POOL, CACHE, MAX_BATCH
+    POOL = AsyncRedisPool(**redis_config)
+    MAX_BATCH = server_config['max_batch']
+    if server_config['cache']:
+        CACHE = AsyncHotCache(POOL, **server_config['cache_options'])
+    global METRICS, KEYS
+    METRICS = get_metrics_config(dir)
+    if METRICS is None:
+        metrics.disable_instrumentation()
+    KEYS = frozenset(synch_config['second_db_keys'])
+
+
+def _get_batch_size(n):
+    return min(max(int(n), 1), MAX_BATCH)
+
+
+def _get_score_range(request):
+    _min = int(request.query_params.get('min', '0'))
+    _max = int(request.query_params.get('max', '100'))
+    _min = 0 if (_min < 0 or _min > 100) else _min
+    _max = 100 if (_max < _min or _max > 100) else _max
+    return _min, _max
+
+
+async def get_proxy_randomly(request):
+    """
+    'key' is a key in second-level pool
+    'n' checks out n distinct proxies at once, 'weight=score' prefers higher scores,
+    'weight=latency' prefers the faster of two random proxies for every pick
+    """
+    key = request.query_params.get('key')
+    n = request.query_params.get('n')
+    weight = request.query_params.get('weight') if request.query_params.get('weight') in ('score', 'latency') else ''
+    try:
+        if key and key.startswith(META_PREFIX):
+            res = {
+                'errMsg': 'invalid key: {}'.format(key)
+            }
+        elif key and n:
+            proxies = await (CACHE or POOL).z_random_get_many(key=key, n=_get_batch_size(n), weight=weight)
+            res = {
+                'proxies': proxies
+            }
+        elif key:
+            if weight == 'latency':
+                proxy = (await (CACHE or POOL).z_random_get_many(key=key, weight=weight))[0]
+            else:
+                proxy = await (CACHE or POOL).z_random_get_one(key=key)
+            res = {
+                'proxy': proxy
+            }
+        else:
+            res = {
+                'errMsg': 'please input a key'
+            }
+    except PoolEmptyException:
+        metrics.observe_pool_empty(key, KEYS)
+        res = {
+            'errMsg': 'proxy pool is empty: {}'.format(str(traceback.format_exc()))
+        }
+    except Exception:
+        res = {
+            'errMsg': 'query error{}'.format(str(traceback.format_exc()))
+        }
+    return JSONResponse(res)
+
+
+async def get_proxy_total_num(request):
+    _key = request.query_params.get('key')
+    _min, _max = _get_score_range(request)
+    res = {}
+    if _key and await POOL.z_exists(_key):
+        res[_key] = await POOL.z_get_total_num(_key, min_score=_min, max_score=_max)
+    else:
+        res['errMsg'] = 'invalid key: {}'.format(_key)
+    return JSONResponse(res)
+
+
+async def get_proxy_list(request):
+    _key = request.query_params.get('key')
+    _min, _max = _get_score_range(request)
+    res = {}
+    if not _key or not await POOL.z_exists(_key):
+        res['errMsg'] = 'invalid key: {}'.format(_key)
+    else:
+        _list = await POOL.z_get_total_num(_key, min_score=_min, max_score=_max, get_list=True)
+        res[_key] = {
+            'total': len(_list),
+            'list': _list
+        }
+    return JSONResponse(res)
+
+
+async def get_metrics(request):
+    """
+    metrics of this worker and of every process pushing to second-level pool
+    """
+    if not METRICS:
+        return Response(metrics.render(metrics.REGISTRY.snapshot()), media_type=metrics.CONTENT_TYPE)
+    await POOL.push_metrics(metrics.process_id('server'), metrics.dump('server'))
+    text, stale = metrics.collect(await POOL.get_metrics(), max_age=3 * METRICS['interval'])
+    await POOL.delete_metrics(stale)
+    return Response(text, media_type=metrics.CONTENT_TYPE)
+
+
+async def _push_forever(interval):
+    field = metrics.process_id('server')
+    failing = False
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            await POOL.push_metrics(field, metrics.dump('server'))
+        except Exception:
+            if not failing:
+                metrics.logger.warning('metrics push of {} failed: {}'.format(field, traceback.format_exc()))
+            failing = True
+        else:
+            failing = False
+
+
+class MetricsMiddleware(object):
+    """
+    records every request, and starts the pusher of this worker in its serving loop.
+    """
+    def __init__(self, app):
+        self._app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http':
+            return await self._app(scope, receive, send)
+        global PUSHER
+        if METRICS and PUSHER is None:
+            PUSHER = asyncio.get_running_loop().create_task(_push_forever(METRICS['interval']))
+        response = {'status': 500}
+
+        async def _send(message):
+            if message['type'] == 'http.response.start':
+                response['status'] = message['status']
+            await send(message)
+
+        _start = time.monotonic()
+        try:
+            await self._app(scope, receive, _send)
+        finally:
+            endpoint = scope['path'] if scope['path'] in ENDPOINTS else 'other'
+            metrics.observe_request(endpoint, response['status'], time.monotonic() - _start)
+
+
+@asynccontextmanager
+async def lifespan(app):
+    yield
+    if PUSHER:
+        PUSHER.cancel()
+    if CACHE:
+        await CACHE.close()
+    await POOL.close()
+
+
+def create_app():
+    routes = [
+        Route('/proxy/random/', get_proxy_randomly),
+        Route('/proxy/total/', get_proxy_total_num),
+        Route('/proxy/list/', get_proxy_list),
+        Route('/metrics', get_metrics),
+    ]
+    app = Starlette(routes=routes, lifespan=lifespan)
+    app.add_middleware(MetricsMiddleware)
+    return app
+
+
+def make_app(dir):
+    get_second_level_pool(dir)
+    return create_app()
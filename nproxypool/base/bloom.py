@@ -0,0 +1,62 @@
+# =============================================
+# recently-seen filter for fetchers
+# ---------------------------------------------
+# two Bloom filters used as generations: proxies are added to the current one,
+# looked up in both, and the older one is dropped every ttl / 2 seconds, so a
+# proxy is remembered for ttl / 2 to ttl seconds. False positives(a proxy
+# never seen reported as seen) happen at about error_rate while the current
+# generation holds at most capacity proxies.
+# ==============================================
+import math
+import time
+from hashlib import blake2b
+
+
+class BloomFilter(object):
+    def __init__(self, capacity=100000, error_rate=0.01):
+        self._size = max(int(-capacity * math.log(error_rate) / math.log(2) ** 2), 8)
+        self._hashes = max(int(round(self._size / capacity * math.log(2))), 1)
+        self._bits = bytearray((self._size + 7) // 8)
+
+    def _positions(self, item):
+        digest = blake2b(item.encode() if isinstance(item, str) else item, digest_size=16).digest()
+        h1, h2 = int.from_bytes(digest[:8], 'little'), int.from_bytes(digest[8:], 'little')
+        return [(h1 + i * h2) % self._size for i in range(self._hashes)]
+
+    def add(self, item):
+        for pos in self._positions(item):
+            self._bits[pos >> 3] |= 1 << (pos & 7)
+
+    def __contains__(self, item):
+        return all(self._bits[pos >> 3] & (1 << (pos & 7)) for pos in self._positions(item))
+
+
+class RecentlySeenFilter(object):
+    def __init__(self, ttl=600, capacity=100000, error_rate=0.01):
+        self._ttl = ttl
+        self._capacity = capacity
+        self._error_rate = error_rate
+        self._current = BloomFilter(capacity, error_rate)
+        self._previous = BloomFilter(capacity, error_rate)
+        self._rotated_at = time.monotonic()
+
+    def _rotate(self):
+        now = time.monotonic()
+        if now - self._rotated_at >= self._ttl / 2:
+            self._previous, self._current = self._current, BloomFilter(self._capacity, self._error_rate)
+            self._rotated_at = now
+
+    def contains(self, item):
+        """
+        test whether item was seen recently
+        """
+        self._rotate()
+        return item in self._current or item in self._previous
+
+    def add_many(self, items):
+        """
+        remember items as seen
+        """
+        self._rotate()
+        for item in items:
+            self._current.add(item)
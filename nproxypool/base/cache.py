@@ -0,0 +1,273 @@
+# ========================================================
+# per-worker hot cache of the top tier(85-100) of second-level keys
+# --------------------------------------------------------
+# a cached tier is reloaded when its ttl expires or when the version of the key,
+# bumped by verifiers and the synchronizer whenever a proxy enters or leaves the tier, has changed.
+# checkouts are served from memory in O(n) for n proxies, whatever the size of the tier,
+# and their score decrements are written back to Redis in batches.
+# latency weighted checkouts are not cached, they always go to Redis.
+# ========================================================
+import time
+import random
+import atexit
+import asyncio
+import threading
+import traceback
+from collections import OrderedDict, Counter, defaultdict
+from nproxypool.base.logger import get_logger
+
+logger = get_logger(name='hot_cache')
+
+
+class _Candidates(object):
+    """
+    proxies with O(1) add, remove and random choice.
+    """
+    def __init__(self, proxies=()):
+        self._items = list(proxies)
+        self._index = {p: i for i, p in enumerate(self._items)}
+
+    def __len__(self):
+        return len(self._items)
+
+    def __contains__(self, proxy):
+        return proxy in self._index
+
+    def __iter__(self):
+        return iter(self._items)
+
+    def add(self, proxy):
+        if proxy not in self._index:
+            self._index[proxy] = len(self._items)
+            self._items.append(proxy)
+
+    def remove(self, proxy):
+        i = self._index.pop(proxy, None)
+        if i is None:
+            return
+        last = self._items.pop()
+        if i < len(self._items):
+            self._items[i] = last
+            self._index[last] = i
+
+    def choice(self):
+        return self._items[random.randrange(len(self._items))]
+
+    def sample(self, n):
+        return random.sample(self._items, min(n, len(self._items)))
+
+
+class HotCacheBase(object):
+    def __init__(self, pool, ttl=5, max_keys=64, check_interval=1, flush_interval=1):
+        """
+        pool: RedisPool or AsyncRedisPool of second-level pool
+        ttl: seconds a cached tier is served at most
+        max_keys: keys kept in cache, the least recently used one is dropped
+        check_interval: seconds between two version checks of a key
+        flush_interval: seconds between two write-backs of usage decrements
+        """
+        self._pool = pool
+        self._ttl = ttl
+        self._max_keys = max_keys
+        self._check_interval = check_interval
+        self._flush_interval = flush_interval
+        self._entries = OrderedDict()
+        self._pending = defaultdict(Counter)
+
+    def _lookup(self, key, now):
+        """
+        return: (entry, to_reload, to_check)
+        """
+        entry = self._entries.get(key)
+        if entry is None or now - entry['loaded_at'] > self._ttl:
+            return entry, True, False
+        self._entries.move_to_end(key)
+        return entry, False, now - entry['checked_at'] > self._check_interval
+
+    def _store(self, key, version, members, now):
+        """
+        the proxies scored 100 and the whole tier are indexed once here, not on every checkout.
+        """
+        tier = dict(members)
+        entry = {
+            'version': version,
+            'tier': tier,
+            'top': _Candidates(p for p, s in tier.items() if s >= 100),
+            'all': _Candidates(tier),
+            'loaded_at': now,
+            'checked_at': now
+        }
+        self._entries[key] = entry
+        self._entries.move_to_end(key)
+        while len(self._entries) > self._max_keys:
+            self._entries.popitem(last=False)
+        return entry
+
+    @staticmethod
+    def _weighted_sample(tier, candidates, n):
+        """
+        n distinct proxies weighted by score: a uniform choice is kept with probability score/100,
+        scores of the tier being 85-100 few choices are drawn again.
+        """
+        n = min(n, len(candidates))
+        if n * 2 > len(candidates):
+            return sorted(candidates, key=lambda p: random.random() ** (1 / max(tier[p], 1)), reverse=True)[:n]
+        picked = {}
+        while len(picked) < n:
+            proxy = candidates.choice()
+            if proxy not in picked and random.random() * 100 < tier[proxy]:
+                picked[proxy] = None
+        return list(picked)
+
+    def _pick(self, key, entry, n=1, weight=''):
+        """
+        same choice as the checkout scripts: proxies scored 100, or 85-100 if less than n.
+        """
+        tier, top, candidates = entry['tier'], entry['top'], entry['all']
+        if len(top) >= n:
+            candidates = top
+        if weight == 'score':
+            picked = self._weighted_sample(tier, candidates, n)
+        else:
+            picked = candidates.sample(n)
+        for proxy in picked:
+            self._pending[key][proxy] += 1
+            tier[proxy] -= 1
+            if tier[proxy] < 100:
+                top.remove(proxy)
+            if tier[proxy] < 85:
+                del tier[proxy]
+                entry['all'].remove(proxy)
+        return picked
+
+    def _take_pending(self):
+        pending, self._pending = self._pending, defaultdict(Counter)
+        return pending
+
+
+class HotCache(HotCacheBase):
+    """
+    for the sync server, decrements are flushed by a daemon thread started on first use,
+    so each forked worker owns its own thread.
+    """
+    def __init__(self, pool, **kwargs):
+        super(HotCache, self).__init__(pool, **kwargs)
+        self._lock = threading.RLock()
+        self._flusher = None
+
+    def _start_flusher(self):
+        if self._flusher is None:
+            self._flusher = threading.Thread(target=self._flush_forever, daemon=True)
+            self._flusher.start()
+            atexit.register(self.flush)
+
+    def _flush_forever(self):
+        failing = False
+        while True:
+            time.sleep(self._flush_interval)
+            try:
+                self.flush()
+            except Exception:
+                # once per failure streak, redis being down fails every flush
+                if not failing:
+                    logger.warning('hot cache flush failed: {}'.format(traceback.format_exc()))
+                failing = True
+            else:
+                failing = False
+
+    def flush(self):
+        with self._lock:
+            pending = self._take_pending()
+        for key, usage in pending.items():
+            self._pool.z_decrease_many(key, usage)
+
+    def _get_entry(self, key):
+        now = time.monotonic()
+        with self._lock:
+            entry, to_reload, to_check = self._lookup(key, now)
+        if to_check:
+            if self._pool.z_get_version(key) == entry['version']:
+                entry['checked_at'] = now
+            else:
+                to_reload = True
+        if to_reload:
+            version, members = self._pool.z_get_tier(key)
+            with self._lock:
+                entry = self._store(key, version, members, now)
+        return entry
+
+    def z_random_get_many(self, key='baidu', n=1, weight=''):
+        if weight == 'latency':
+            return self._pool.z_random_get_many(key=key, n=n, weight=weight)
+        self._start_flusher()
+        entry = self._get_entry(key)
+        with self._lock:
+            picked = self._pick(key, entry, n=n, weight=weight)
+        if not picked:
+            return self._pool.z_random_get_many(key=key, n=n, weight=weight)
+        return picked
+
+    def z_random_get_one(self, key='baidu'):
+        return self.z_random_get_many(key=key)[0]
+
+
+class AsyncHotCache(HotCacheBase):
+    """
+    for the async server, decrements are flushed by a task started on first use in the serving loop.
+    """
+    def __init__(self, pool, **kwargs):
+        super(AsyncHotCache, self).__init__(pool, **kwargs)
+        self._flusher = None
+
+    def _start_flusher(self):
+        if self._flusher is None:
+            self._flusher = asyncio.get_running_loop().create_task(self._flush_forever())
+
+    async def _flush_forever(self):
+        failing = False
+        while True:
+            await asyncio.sleep(self._flush_interval)
+            try:
+                await self.flush()
+            except Exception:
+                if not failing:
+                    logger.warning('hot cache flush failed: {}'.format(traceback.format_exc()))
+                failing = True
+            else:
+                failing = False
+
+    async def flush(self):
+        for key, usage in self._take_pending().items():
+            await self._pool.z_decrease_many(key, usage)
+
+    async def close(self):
+        if self._flusher is not None:
+            self._flusher.cancel()
+            self._flusher = None
+        await self.flush()
+
+    async def _get_entry(self, key):
+        now = time.monotonic()
+        entry, to_reload, to_check = self._lookup(key, now)
+        if to_check:
+            if await self._pool.z_get_version(key) == entry['version']:
+                entry['checked_at'] = now
+            else:
+                to_reload = True
+        if to_reload:
+            version, members = await self._pool.z_get_tier(key)
+            entry = self._store(key, version, members, now)
+        return entry
+
+    async def z_random_get_many(self, key='baidu', n=1, weight=''):
+        if weight == 'latency':
+            return await self._pool.z_random_get_many(key=key, n=n, weight=weight)
+        self._start_flusher()
+        entry = await self._get_entry(key)
+        picked = self._pick(key, entry, n=n, weight=weight)
+        if not picked:
+            return await self._pool.z_random_get_many(key=key, n=n, weight=weight)
+        return picked
+
+    async def z_random_get_one(self, key='baidu'):
+        return (await self.z_random_get_many(key=key))[0]
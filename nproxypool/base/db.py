@@ -3,15 +3,484 @@
 # every IP has an initial score as 60, decreases by 30 when a verification failure occurred,
 # increase to 100 when a verification success occurred. An IP is removed when its score reach below 20.
 #
+# In first-level pool, a proxy is stored with one of two layouts(the layout option of [redis]):
+#   string: '{expire};{score}', the expire time repeating the TTL of the key
+#   packed: 6 bytes, score(uint8), fail streak(uint8), last latency in ms(uint16) and
+#           source id(uint16, see SOURCES_KEY), big-endian. Expiry is the TTL only,
+#           and a field is updated in place with SETRANGE.
+#
 # The score of an IP is decreased by 1 when fetched by a client.
 # One ip is chosen among the highest scored ones when fetched by a client.
 # -----------------------------------------
 import time
-from random import choice
+import struct
+import inspect
+from functools import wraps
+from itertools import islice
+from random import randint
+from contextvars import ContextVar
 from redis import ConnectionPool, StrictRedis
+from nproxypool.base import metrics
+from nproxypool.base.metrics import Counter, Histogram, METRICS_KEY
 from nproxypool.utils.exceptions import PoolEmptyException
 
 
+# keys under this prefix hold pool metadata, never proxies
+META_PREFIX = '__npool__:'
+# hash of zset key -> version, bumped whenever verifiers or the synchronizer change the zset
+VERSION_KEY = META_PREFIX + 'version'
+# per verifier: zset of proxy -> next due time, and hash of proxy -> result streak
+DUE_PREFIX = META_PREFIX + 'due:'
+STREAK_PREFIX = META_PREFIX + 'streak:'
+# per zset key: hash of proxy -> 'ewma;p95;ms,ms,...' of the latest successful probes
+LATENCY_PREFIX = META_PREFIX + 'lat:'
+# hash of fetcher name -> source id stored in packed records, and of SOURCES_SEQ_FIELD -> last id given
+SOURCES_KEY = META_PREFIX + 'sources'
+SOURCES_SEQ_FIELD = '__seq__'
+PACKED_RECORD = struct.Struct('>BBHH')
+
+# pack helpers shared by the scripts handling packed records
+PACKED_LUA = """
+local function u8(n)
+    return string.char(math.max(0, math.min(math.floor(n), 255)))
+end
+local function u16(n)
+    n = math.max(0, math.min(math.floor(n), 65535))
+    return string.char(math.floor(n / 256), n % 256)
+end
+local function string_score(value)
+    return tonumber(string.match(value, ';(%-?[%d.]+)$'))
+end
+"""
+
+# apply one batch of verification results to the first-level pool.
+# KEYS: proxies
+# ARGV: now, score_threshold, to_decr, init_score, init_expire, success_score, then one flag per key('1' success)
+KEY_UPDATE_SCRIPT = """
+local now = tonumber(ARGV[1])
+local threshold = tonumber(ARGV[2])
+local decr = tonumber(ARGV[3])
+local init_score = ARGV[4]
+local init_expire = tonumber(ARGV[5])
+local success_score = ARGV[6]
+for i, key in ipairs(KEYS) do
+    local success = ARGV[6 + i] == '1'
+    local value = redis.call('GET', key)
+    if value then
+        local sep = string.find(value, ';', 1, true)
+        if sep then
+            local expire = tonumber(string.sub(value, 1, sep - 1)) or (now - 300)
+            local score = tonumber(string.sub(value, sep + 1)) or 0
+            if success then
+                score = success_score
+            else
+                score = score - decr
+            end
+            if (not success) and score <= threshold then
+                redis.call('DEL', key)
+            else
+                redis.call('SET', key, string.format('%d;%s', expire, score))
+                redis.call('EXPIREAT', key, expire)
+            end
+        end
+    elseif success then
+        local expire = now + init_expire
+        redis.call('SET', key, string.format('%d;%s', expire, init_score))
+        redis.call('EXPIREAT', key, expire)
+    end
+end
+return #KEYS
+"""
+
+# same as KEY_UPDATE_SCRIPT for packed records, a record of the string layout is converted first.
+# KEYS: proxies
+# ARGV: score_threshold, to_decr, init_score, init_expire, success_score,
+#       then one flag('1' success) and one latency in ms per key
+PACKED_UPDATE_SCRIPT = PACKED_LUA + """
+local threshold = tonumber(ARGV[1])
+local decr = tonumber(ARGV[2])
+local init_score = tonumber(ARGV[3])
+local init_expire = tonumber(ARGV[4])
+local success_score = tonumber(ARGV[5])
+for i, key in ipairs(KEYS) do
+    local success = ARGV[4 + 2 * i] == '1'
+    local latency = tonumber(ARGV[5 + 2 * i]) or 0
+    local value = redis.call('GET', key)
+    local missing = not value
+    if value and #value ~= 6 then
+        local score = string_score(value)
+        if score then
+            local ttl = redis.call('PTTL', key)
+            value = u8(score) .. u8(0) .. u16(0) .. u16(0)
+            redis.call('SET', key, value)
+            if ttl > 0 then
+                redis.call('PEXPIRE', key, ttl)
+            end
+        else
+            value = nil
+        end
+    end
+    if value then
+        local score, fails = string.byte(value, 1, 2)
+        if success then
+            redis.call('SETRANGE', key, 0, u8(success_score) .. u8(0) .. u16(latency))
+        else
+            score = score - decr
+            if score <= threshold then
+                redis.call('DEL', key)
+            else
+                redis.call('SETRANGE', key, 0, u8(score) .. u8(fails + 1))
+            end
+        end
+    elseif success and missing then
+        redis.call('SET', key, u8(init_score) .. u8(0) .. u16(latency) .. u16(0), 'EX', init_expire)
+    end
+end
+return #KEYS
+"""
+
+# convert records of first-level pool to another layout, keeping their TTL.
+# KEYS: proxies
+# ARGV: layout to convert to('packed' or 'string'), now
+# return: number of records converted
+MIGRATE_SCRIPT = PACKED_LUA + """
+local now = tonumber(ARGV[2])
+local migrated = 0
+for _, key in ipairs(KEYS) do
+    if redis.call('TYPE', key).ok == 'string' then
+        local value = redis.call('GET', key)
+        local ttl = redis.call('PTTL', key)
+        local new_value = nil
+        if ARGV[1] == 'packed' and #value ~= 6 and string_score(value) then
+            new_value = u8(string_score(value)) .. u8(0) .. u16(0) .. u16(0)
+        elseif ARGV[1] == 'string' and #value == 6 then
+            local expire = now + (ttl > 0 and math.ceil(ttl / 1000) or 0)
+            new_value = string.format('%d;%d', expire, string.byte(value, 1))
+        end
+        if new_value then
+            redis.call('SET', key, new_value)
+            if ttl > 0 then
+                redis.call('PEXPIRE', key, ttl)
+            end
+            migrated = migrated + 1
+        end
+    end
+end
+return migrated
+"""
+
+# apply one batch of verification results to a zset in second-level pool.
+# the version is only bumped when a proxy enters or leaves the top tier(tier_min_score and above),
+# the part of the zset cached by the servers. Removed proxies leave the latency hash too.
+# KEYS: zset key, version key, latency hash
+# ARGV: score_threshold, to_decr, success_score, tier_min_score, then pairs of proxy and flag('1' success)
+ZSET_UPDATE_SCRIPT = """
+local threshold = tonumber(ARGV[1])
+local decr = tonumber(ARGV[2])
+local success_score = ARGV[3]
+local tier_min = tonumber(ARGV[4])
+local changed = false
+for i = 5, #ARGV, 2 do
+    local proxy = ARGV[i]
+    local score = redis.call('ZSCORE', KEYS[1], proxy)
+    if ARGV[i + 1] == '1' then
+        if not score or tonumber(score) < tier_min then
+            changed = true
+        end
+        redis.call('ZADD', KEYS[1], success_score, proxy)
+    elseif score then
+        score = tonumber(score)
+        if score >= tier_min and score - decr < tier_min then
+            changed = true
+        end
+        if score - decr <= threshold then
+            redis.call('ZREM', KEYS[1], proxy)
+            redis.call('HDEL', KEYS[3], proxy)
+        else
+            redis.call('ZINCRBY', KEYS[1], 0 - decr, proxy)
+        end
+    end
+end
+if changed then
+    redis.call('HINCRBY', KEYS[2], KEYS[1], 1)
+end
+return (#ARGV - 4) / 2
+"""
+
+# decrease the scores of proxies still in a zset, used to write back usage counted elsewhere.
+# KEYS: zset key, latency hash
+# ARGV: score_threshold, then pairs of proxy and amount
+Z_DECREASE_SCRIPT = """
+local threshold = tonumber(ARGV[1])
+for i = 2, #ARGV, 2 do
+    local score = redis.call('ZSCORE', KEYS[1], ARGV[i])
+    if score then
+        if tonumber(score) - tonumber(ARGV[i + 1]) <= threshold then
+            redis.call('ZREM', KEYS[1], ARGV[i])
+            redis.call('HDEL', KEYS[2], ARGV[i])
+        else
+            redis.call('ZINCRBY', KEYS[1], 0 - tonumber(ARGV[i + 1]), ARGV[i])
+        end
+    end
+end
+return (#ARGV - 1) / 2
+"""
+
+# check out a random proxy from the top tier of a zset and decrease its score, atomically.
+# the tier is [min_score, max_score], widened to [fallback_min_score, max_score] when empty.
+# KEYS: zset key, latency hash
+# ARGV: random seed, min_score, fallback_min_score, max_score, to_decr, score_threshold
+Z_CHECKOUT_SCRIPT = """
+math.randomseed(tonumber(ARGV[1]))
+local key = KEYS[1]
+local min_score = ARGV[2]
+local max_score = ARGV[4]
+local decr = tonumber(ARGV[5])
+local threshold = tonumber(ARGV[6])
+local n = redis.call('ZCOUNT', key, min_score, max_score)
+if n == 0 then
+    min_score = ARGV[3]
+    n = redis.call('ZCOUNT', key, min_score, max_score)
+end
+if n == 0 then
+    return false
+end
+local rank = redis.call('ZCOUNT', key, '-inf', '(' .. min_score) + math.random(n) - 1
+local proxy = redis.call('ZRANGE', key, rank, rank)[1]
+local score = tonumber(redis.call('ZSCORE', key, proxy))
+if score - decr <= threshold then
+    redis.call('ZREM', key, proxy)
+    redis.call('HDEL', KEYS[2], proxy)
+else
+    redis.call('ZINCRBY', key, 0 - decr, proxy)
+end
+return proxy
+"""
+
+# check out n distinct proxies from the top tier of a zset and decrease their scores, atomically.
+# the tier is widened to [fallback_min_score, max_score] when it holds less than n proxies.
+# weight 'score' samples without replacement weighted by score among 4n random proxies of the tier,
+# so a checkout costs O(n log N) whatever the size N of the tier,
+# 'latency' keeps the faster of two random proxies for every pick(unmeasured ones lose),
+# otherwise uniformly.
+# KEYS: zset key, latency hash
+# ARGV: random seed, min_score, fallback_min_score, max_score, to_decr, score_threshold, n, weight
+Z_CHECKOUT_MANY_SCRIPT = """
+math.randomseed(tonumber(ARGV[1]))
+local key = KEYS[1]
+local min_score = ARGV[2]
+local max_score = ARGV[4]
+local decr = tonumber(ARGV[5])
+local threshold = tonumber(ARGV[6])
+local n = tonumber(ARGV[7])
+local total = redis.call('ZCOUNT', key, min_score, max_score)
+if total < n then
+    min_score = ARGV[3]
+    total = redis.call('ZCOUNT', key, min_score, max_score)
+end
+if total == 0 then
+    return {}
+end
+local first = redis.call('ZCOUNT', key, '-inf', '(' .. min_score)
+local picked = {}
+if ARGV[8] == 'score' then
+    local ranks = {}
+    local keyed = {}
+    for i = 0, math.min(4 * n, total) - 1 do
+        local j = i + math.random(total - i) - 1
+        local rank = ranks[j] or j
+        ranks[j] = ranks[i] or i
+        local member = redis.call('ZRANGE', key, first + rank, first + rank, 'WITHSCORES')
+        keyed[#keyed + 1] = {member[1], math.random() ^ (1 / math.max(tonumber(member[2]), 1))}
+    end
+    table.sort(keyed, function(a, b) return a[2] > b[2] end)
+    for i = 1, math.min(n, #keyed) do
+        picked[i] = keyed[i][1]
+    end
+else
+    local fast = ARGV[8] == 'latency'
+    local function latency(rank)
+        local value = redis.call('HGET', KEYS[2], redis.call('ZRANGE', key, first + rank, first + rank)[1])
+        return value and tonumber(string.match(value, '^[^;]+')) or math.huge
+    end
+    local ranks = {}
+    for i = 0, math.min(n, total) - 1 do
+        local j = i + math.random(total - i) - 1
+        if fast and total - i > 1 then
+            local k = i + math.random(total - i) - 1
+            if latency(ranks[k] or k) < latency(ranks[j] or j) then
+                j = k
+            end
+        end
+        local rank = ranks[j] or j
+        ranks[j] = ranks[i] or i
+        picked[#picked + 1] = redis.call('ZRANGE', key, first + rank, first + rank)[1]
+    end
+end
+for _, proxy in ipairs(picked) do
+    local score = tonumber(redis.call('ZSCORE', key, proxy))
+    if score - decr <= threshold then
+        redis.call('ZREM', key, proxy)
+        redis.call('HDEL', KEYS[2], proxy)
+    else
+        redis.call('ZINCRBY', key, 0 - decr, proxy)
+    end
+end
+return picked
+"""
+
+# reschedule one batch of verification results.
+# a success streak of n doubles the interval n - 1 times up to max_interval,
+# a failure puts the proxy back to min_interval. Entries not rescheduled for
+# 2 * max_interval belong to proxies gone from the pool and are dropped.
+# KEYS: due zset, streak hash
+# ARGV: seed, now, min_interval, max_interval, then proxy/flag pairs('1' success)
+SCHEDULE_SCRIPT = """
+math.randomseed(tonumber(ARGV[1]))
+local now = tonumber(ARGV[2])
+local min_interval = tonumber(ARGV[3])
+local max_interval = tonumber(ARGV[4])
+for i = 5, #ARGV, 2 do
+    local proxy = ARGV[i]
+    local streak = tonumber(redis.call('HGET', KEYS[2], proxy) or '0')
+    local interval = min_interval
+    if ARGV[i + 1] == '1' then
+        streak = math.max(streak, 0) + 1
+        interval = math.min(min_interval * 2 ^ (streak - 1), max_interval)
+    else
+        streak = math.min(streak, 0) - 1
+    end
+    redis.call('HSET', KEYS[2], proxy, streak)
+    redis.call('ZADD', KEYS[1], now + interval * (0.9 + 0.2 * math.random()), proxy)
+end
+local stale = redis.call('ZRANGEBYSCORE', KEYS[1], '-inf', now - 2 * max_interval, 'LIMIT', 0, 500)
+if #stale > 0 then
+    redis.call('ZREM', KEYS[1], unpack(stale))
+    redis.call('HDEL', KEYS[2], unpack(stale))
+end
+"""
+
+# record the latency of successful probes and forget the latency of failed ones.
+# the value is 'ewma;p95;samples', samples being the last `window` latencies in ms.
+# KEYS: latency hash
+# ARGV: alpha, window, then proxy/latency pairs(latency '' on failure)
+LATENCY_UPDATE_SCRIPT = """
+local alpha = tonumber(ARGV[1])
+local window = tonumber(ARGV[2])
+for i = 3, #ARGV, 2 do
+    local proxy = ARGV[i]
+    local ms = tonumber(ARGV[i + 1])
+    if ms then
+        local ewma = ms
+        local samples = {}
+        local value = redis.call('HGET', KEYS[1], proxy)
+        if value then
+            local old, _, tail = string.match(value, '^([^;]*);([^;]*);(.*)$')
+            ewma = alpha * ms + (1 - alpha) * (tonumber(old) or ms)
+            for sample in string.gmatch(tail or '', '%d+') do
+                samples[#samples + 1] = tonumber(sample)
+            end
+        end
+        samples[#samples + 1] = math.floor(ms + 0.5)
+        while #samples > window do
+            table.remove(samples, 1)
+        end
+        local sorted = {unpack(samples)}
+        table.sort(sorted)
+        local p95 = sorted[math.ceil(#sorted * 0.95)]
+        redis.call('HSET', KEYS[1], proxy, string.format('%d;%d;%s', ewma, p95, table.concat(samples, ',')))
+    else
+        redis.call('HDEL', KEYS[1], proxy)
+    end
+end
+"""
+
+
+def _chunks(items, size):
+    for i in range(0, len(items), size):
+        yield items[i:i + size]
+
+
+# ====================================
+#  instrumentation
+# ====================================
+REDIS_ROUND_TRIPS = Counter('npool_redis_round_trips_total', 'Redis round trips by pool operation')
+REDIS_OP_SECONDS = Histogram('npool_redis_op_seconds', 'Duration of pool operations')
+_current_op = ContextVar('npool_redis_op', default='other')
+
+
+class CountingRedis(StrictRedis):
+    """
+    counts round trips, a pipeline being one, under the pool operation running(SCAN iterators under 'other').
+    """
+    def execute_command(self, *args, **options):
+        if metrics.INSTRUMENTED:
+            REDIS_ROUND_TRIPS.inc(op=_current_op.get())
+        return super(CountingRedis, self).execute_command(*args, **options)
+
+    def pipeline(self, transaction=True, shard_hint=None):
+        pipe = super(CountingRedis, self).pipeline(transaction, shard_hint)
+        execute = pipe.execute
+
+        def _execute(*args, **kwargs):
+            if pipe.command_stack and metrics.INSTRUMENTED:
+                REDIS_ROUND_TRIPS.inc(op=_current_op.get())
+            return execute(*args, **kwargs)
+
+        pipe.execute = _execute
+        return pipe
+
+
+def _timed(func):
+    if inspect.iscoroutinefunction(func):
+        @wraps(func)
+        async def async_wrapper(self, *args, **kwargs):
+            if not metrics.INSTRUMENTED:
+                return await func(self, *args, **kwargs)
+            token = _current_op.set(func.__name__)
+            _start = time.monotonic()
+            try:
+                return await func(self, *args, **kwargs)
+            finally:
+                REDIS_OP_SECONDS.observe(time.monotonic() - _start, op=func.__name__)
+                _current_op.reset(token)
+        return async_wrapper
+
+    @wraps(func)
+    def wrapper(self, *args, **kwargs):
+        if not metrics.INSTRUMENTED:
+            return func(self, *args, **kwargs)
+        token = _current_op.set(func.__name__)
+        _start = time.monotonic()
+        try:
+            return func(self, *args, **kwargs)
+        finally:
+            REDIS_OP_SECONDS.observe(time.monotonic() - _start, op=func.__name__)
+            _current_op.reset(token)
+    return wrapper
+
+
+def _untimed(func):
+    """
+    mark a method returning a lazy iterator, its round trips happen while the caller consumes it.
+    """
+    func._untimed = True
+    return func
+
+
+def _instrument(cls):
+    """
+    time the public operations(coroutines included) of a pool class and attribute their round trips to them.
+    generators and methods marked by _untimed are left alone.
+    """
+    for name, func in list(vars(cls).items()):
+        if (inspect.isfunction(func) and not name.startswith('_') and not getattr(func, '_untimed', False)
+                and not inspect.isgeneratorfunction(func) and not inspect.isasyncgenfunction(func)):
+            setattr(cls, name, _timed(func))
+    return cls
+
+
+@_instrument
 class RedisPoolBase(object):
     def __init__(self, **kwargs):
         self._kwargs = kwargs
@@ -19,11 +488,23 @@ class RedisPoolBase(object):
         self._client = None
         self._get_client()
         self._value_pattern = '{};{}'
+        self._layout = kwargs.get('layout', 'string')
+        self._source_ids = {}
+        self._key_update_script = self._client.register_script(KEY_UPDATE_SCRIPT)
+        self._packed_update_script = self._client.register_script(PACKED_UPDATE_SCRIPT)
+        self._migrate_script = self._client.register_script(MIGRATE_SCRIPT)
+        self._schedule_script = self._client.register_script(SCHEDULE_SCRIPT)
 
     def __del__(self):
         if self._client:
             self._client.connection_pool.disconnect()
 
+    def close(self):
+        """
+        disconnect the connection pool now instead of when the pool is garbage collected.
+        """
+        self._client.connection_pool.disconnect()
+
     def _get_client(self):
         if not self._kwargs.get('uri'):
             password = self._kwargs.get('password', '')
@@ -39,7 +520,7 @@ class RedisPoolBase(object):
         else:
             redis_uri = self._kwargs['uri']
         pool = ConnectionPool.from_url(redis_uri)
-        self._client = StrictRedis(connection_pool=pool)
+        self._client = CountingRedis(connection_pool=pool)
 
     @staticmethod
     def _bytes_to_str(_value):
@@ -51,16 +532,76 @@ class RedisPoolBase(object):
     # ====================================
     #  first-level pool operations
     # ====================================
-    def get_all(self):
-        return self._client.keys()
+    @_untimed
+    def iter_all(self, count=1000):
+        """
+        iterate proxies in first-level pool incrementally with SCAN,
+        a proxy may be yielded more than once if the pool changes meanwhile.
+        count: hint of keys to fetch per SCAN call
+        """
+        return self._scan_iter(count)
+
+    def _scan_iter(self, count):
+        prefix = META_PREFIX.encode()
+        for key in self._client.scan_iter(count=count):
+            if not key.startswith(prefix):
+                yield key
+
+    def get_all(self, count=1000):
+        return list(dict.fromkeys(self.iter_all(count=count)))
 
     def get_one(self, key):
         """
         get one proxy from first-level pool
         key: proxy
+        return: '{expire};{score}' whatever the layout, None if not in the pool
         """
-        r = self._client.get(key)
-        return r if not r else self._bytes_to_str(r)
+        if self._layout != 'packed':
+            r = self._client.get(key)
+            return r if not r else self._bytes_to_str(r)
+        record = self.get_record(key)
+        return record and self._value_pattern.format(record['expire'], record['score'])
+
+    def get_record(self, key):
+        """
+        return: dict of score, expire, fails, latency(ms) and source, None if not in the pool.
+                fails, latency and source are None for the string layout
+        """
+        pipe = self._client.pipeline(transaction=False)
+        pipe.get(key)
+        pipe.ttl(key)
+        value, ttl = pipe.execute()
+        if not value:
+            return None
+        expire = int(time.time()) + max(ttl, 0)
+        if len(value) != PACKED_RECORD.size:
+            _, score = self._bytes_to_str(value).split(';')
+            return {'score': int(float(score)), 'expire': expire, 'fails': None, 'latency': None, 'source': None}
+        score, fails, latency, source_id = PACKED_RECORD.unpack(value)
+        return {'score': score, 'expire': expire, 'fails': fails, 'latency': latency, 'source': self._source_name(source_id)}
+
+    def _source_id(self, source):
+        """
+        id of a fetcher name in packed records, 0 if none.
+        """
+        if not source:
+            return 0
+        if source not in self._source_ids:
+            source_id = self._client.hget(SOURCES_KEY, source)
+            if source_id is None:
+                self._client.hsetnx(SOURCES_KEY, source, self._client.hincrby(SOURCES_KEY, SOURCES_SEQ_FIELD, 1))
+                source_id = self._client.hget(SOURCES_KEY, source)
+            self._source_ids[source] = int(source_id) % 65536
+        return self._source_ids[source]
+
+    def _source_name(self, source_id):
+        if not source_id:
+            return None
+        for name, _id in self._client.hgetall(SOURCES_KEY).items():
+            name = self._bytes_to_str(name)
+            if name != SOURCES_SEQ_FIELD and int(_id) == source_id:
+                return name
+        return None
 
     def insert_one(self, key, score=60, expire=600):
         """
@@ -69,16 +610,37 @@ class RedisPoolBase(object):
         score: initial score
         expire: expire time
         """
-        if not self.get_one(key):
-            expire_stamp = int(time.time() + expire)
-            value = self._value_pattern.format(expire_stamp, score)
-            self._client.set(key, value)
-            self._client.expireat(key, expire_stamp)
+        self.insert_many([key], score=score, expire=expire)
+
+    def insert_many(self, proxies, score=60, expire=600, chunk_size=500, source=''):
+        """
+        insert proxies to first-level pool, deduplicated in memory first,
+        then with SET NX in one pipeline per chunk, proxies already in the pool are left untouched.
+        source: name of the fetcher, kept in packed records
+        return: {'proxies': number given, 'new': number inserted, 'duplicates': the others}
+        """
+        proxies = list(proxies)
+        unique = list(dict.fromkeys(self._bytes_to_str(p) for p in proxies))
+        if self._layout == 'packed':
+            value = PACKED_RECORD.pack(min(max(score, 0), 255), 0, 0, self._source_id(source))
+        inserted = 0
+        for chunk in _chunks(unique, chunk_size):
+            if self._layout != 'packed':
+                value = self._value_pattern.format(int(time.time() + expire), score)
+            pipe = self._client.pipeline(transaction=False)
+            for proxy in chunk:
+                pipe.set(proxy, value, ex=expire, nx=True)
+            inserted += sum(1 for res in pipe.execute() if res)
+        return {'proxies': len(proxies), 'new': inserted, 'duplicates': len(proxies) - inserted}
 
     def update_one(self, key, score=60, old_value=''):
         """
         update score but never change the expire time.
         """
+        if self._layout == 'packed':
+            if self._client.exists(key):
+                self._client.setrange(key, 0, bytes([min(max(score, 0), 255)]))
+            return
         old_value = old_value or self.get_one(key)
         _expire = old_value.split(';')[0]
         expire_stamp = int(_expire) if _expire else int(time.time() - 300)
@@ -89,16 +651,122 @@ class RedisPoolBase(object):
     def delete_one(self, key):
         self._client.delete(key)
 
+    def enable_key_events(self, flags='Egx'):
+        """
+        turn on keyevent notifications(E) for generic commands(g, e.g. DEL) and expirations(x),
+        keeping the flags already set on the server.
+        """
+        current = self._client.config_get('notify-keyspace-events').get('notify-keyspace-events', '')
+        merged = ''.join(sorted(set(self._bytes_to_str(current)) | set(flags)))
+        self._client.config_set('notify-keyspace-events', merged)
+
+    def subscribe_key_events(self, events=('expired', 'del')):
+        """
+        return: a pubsub subscribed to the given keyevents of this db, messages carry the key as data
+        """
+        db = self._client.connection_pool.connection_kwargs.get('db', 0)
+        pubsub = self._client.pubsub(ignore_subscribe_messages=True)
+        pubsub.subscribe(*['__keyevent@{}__:{}'.format(db, e) for e in events])
+        return pubsub
+
+    def update_many(self, successes, failures, score_threshold=30, to_decr=30, chunk_size=500, latencies=None):
+        """
+        apply a round of verification results in one script call per chunk.
+        successes: proxies to insert(score 60) or to raise to 100
+        failures: proxies to decrease by to_decr, deleted when reaching score_threshold
+        latencies: dict of proxy -> latency in ms of a success, kept in packed records
+        """
+        results = [(p, '0') for p in failures] + [(p, '1') for p in successes]
+        latencies = latencies or {}
+        for chunk in _chunks(results, chunk_size):
+            keys = [p for p, _ in chunk]
+            if self._layout == 'packed':
+                args = [score_threshold, to_decr, 60, 600, 100]
+                for proxy, flag in chunk:
+                    args.extend((flag, latencies.get(proxy, 0)))
+                self._packed_update_script(keys=keys, args=args)
+            else:
+                args = [int(time.time()), score_threshold, to_decr, 60, 600, 100]
+                args.extend(flag for _, flag in chunk)
+                self._key_update_script(keys=keys, args=args)
 
+    def migrate_layout(self, layout, count=1000, chunk_size=500):
+        """
+        convert every record of first-level pool to layout('packed' or 'string'), keeping TTLs.
+        return: number of records converted
+        """
+        migrated = 0
+        keys = self._scan_iter(count)
+        while True:
+            chunk = list(islice(keys, chunk_size))
+            if not chunk:
+                break
+            migrated += self._migrate_script(keys=chunk, args=[layout, int(time.time())])
+        self._layout = layout
+        return migrated
+
+    # ====================================
+    #  re-verification schedule
+    # ====================================
+    def filter_due(self, name, proxies, now=None):
+        """
+        keep the proxies due for verification by verifier `name`, never verified ones included.
+        """
+        if not proxies:
+            return []
+        now = time.time() if now is None else now
+        pipe = self._client.pipeline(transaction=False)
+        for proxy in proxies:
+            pipe.zscore(DUE_PREFIX + name, proxy)
+        return [p for p, due in zip(proxies, pipe.execute()) if due is None or due <= now]
+
+    def schedule_many(self, name, successes, failures, min_interval=60, max_interval=1800, chunk_size=500):
+        """
+        set the next due time of verified proxies from their result streak.
+        """
+        results = [(p, '0') for p in failures] + [(p, '1') for p in successes]
+        for chunk in _chunks(results, chunk_size):
+            args = [randint(0, 2 ** 31 - 1), time.time(), min_interval, max_interval]
+            for proxy, flag in chunk:
+                args.extend((proxy, flag))
+            self._schedule_script(keys=[DUE_PREFIX + name, STREAK_PREFIX + name], args=args)
+
+
+@_instrument
 class RedisPool(RedisPoolBase):
     def __init__(self, **kwargs):
         super(RedisPool, self).__init__(**kwargs)
+        self._zset_update_script = self._client.register_script(ZSET_UPDATE_SCRIPT)
+        self._z_decrease_script = self._client.register_script(Z_DECREASE_SCRIPT)
+        self._z_checkout_script = self._client.register_script(Z_CHECKOUT_SCRIPT)
+        self._z_checkout_many_script = self._client.register_script(Z_CHECKOUT_MANY_SCRIPT)
+        self._latency_update_script = self._client.register_script(LATENCY_UPDATE_SCRIPT)
 
     # ====================================
     #  second-level pool(zset) operations
     # ====================================
-    def z_get_all_keys(self):
-        return self._client.keys()
+    @_untimed
+    def z_iter_all_keys(self, count=1000):
+        """
+        iterate zset keys in second-level pool incrementally with SCAN
+        """
+        return self._scan_iter(count)
+
+    def z_get_all_keys(self, count=1000):
+        return list(dict.fromkeys(self.z_iter_all_keys(count=count)))
+
+    def z_exists(self, key):
+        """
+        metadata keys(META_PREFIX) are not zsets of proxies and never exist as such.
+        """
+        return not key.startswith(META_PREFIX) and bool(self._client.exists(key))
+
+    def z_iter(self, key, count=1000):
+        """
+        iterate proxies in a zset incrementally with ZSCAN
+        """
+        for proxy, _ in self._client.zscan_iter(key, count=count):
+            yield proxy
 
     def z_get_all(self, key):
         return self._client.zrangebyscore(key, -60, 100)
@@ -119,7 +787,37 @@ class RedisPool(RedisPoolBase):
         self._client.zadd(key, _map)
 
     def z_delete(self, proxy, key):
-        self._client.zrem(key, proxy)
+        self.z_delete_many(key, [proxy])
+
+    def z_delete_many(self, key, proxies):
+        """
+        remove proxies from a zset with one ZREM
+        return: number of proxies removed
+        """
+        if not proxies:
+            return 0
+        pipe = self._client.pipeline(transaction=False)
+        pipe.zrem(key, *proxies)
+        pipe.hdel(LATENCY_PREFIX + key, *proxies)
+        return pipe.execute()[0]
+
+    def z_delete_from_keys(self, keys, proxies):
+        """
+        remove proxies from several zsets in one pipeline, bumping the version of every zset changed
+        return: dict of key -> number of proxies removed
+        """
+        if not proxies or not keys:
+            return {}
+        pipe = self._client.pipeline(transaction=False)
+        for key in keys:
+            pipe.zrem(key, *proxies)
+            pipe.hdel(LATENCY_PREFIX + key, *proxies)
+        removed = dict(zip(keys, pipe.execute()[::2]))
+        for key, num in removed.items():
+            if num:
+                pipe.hincrby(VERSION_KEY, key, 1)
+        pipe.execute()
+        return removed
 
     def z_decrease(self, proxy, key, score_threshold=20, to_decr=30):
         """
@@ -138,17 +836,94 @@ class RedisPool(RedisPoolBase):
                     amount=0 - to_decr
                 )
 
+    def z_update_many(self, key, successes, failures, score_threshold=30, to_decr=30, chunk_size=500):
+        """
+        apply a round of verification results to a zset in one script call per chunk.
+        successes: proxies to set to 100
+        failures: proxies to decrease by to_decr, removed when reaching score_threshold
+        """
+        results = [(p, '0') for p in failures] + [(p, '1') for p in successes]
+        for chunk in _chunks(results, chunk_size):
+            args = [score_threshold, to_decr, 100, 85]
+            for proxy, flag in chunk:
+                args.extend((proxy, flag))
+            self._zset_update_script(keys=[key, VERSION_KEY, LATENCY_PREFIX + key], args=args)
+
+    def z_decrease_many(self, key, usage, score_threshold=20, chunk_size=500):
+        """
+        usage: dict of proxy -> score to decrease by, proxies no longer in the zset are skipped
+        """
+        items = list(usage.items())
+        for chunk in _chunks(items, chunk_size):
+            args = [score_threshold]
+            for proxy, amount in chunk:
+                args.extend((proxy, amount))
+            self._z_decrease_script(keys=[key, LATENCY_PREFIX + key], args=args)
+
+    def z_get_version(self, key):
+        return int(self._client.hget(VERSION_KEY, key) or 0)
+
+    def z_bump_version(self, key):
+        self._client.hincrby(VERSION_KEY, key, 1)
+
+    def z_get_tier(self, key, min_score=85, max_score=100):
+        """
+        get the version of a zset and its proxies scored in [min_score, max_score] in one round trip.
+        return: version, [(proxy, score), ...]
+        """
+        pipe = self._client.pipeline(transaction=False)
+        pipe.hget(VERSION_KEY, key)
+        pipe.zrangebyscore(key, min_score, max_score, withscores=True)
+        version, members = pipe.execute()
+        return int(version or 0), [(self._bytes_to_str(p), s) for p, s in members]
+
     def z_random_get_one(self, key='baidu'):
-        res = self._client.zrangebyscore(key, 100, 100)
-        if not res:
-            res = self._client.zrangebyscore(key, 85, 100)
-        if res:
-            proxy = choice(res)
-            proxy = self._bytes_to_str(proxy)
-            self.z_decrease(proxy, key, to_decr=1)
-            return proxy
-        else:
+        """
+        pick a random proxy scored 100(or 85-100 if none) and decrease it by 1,
+        in a single round trip.
+        """
+        proxy = self._z_checkout_script(
+            keys=[key, LATENCY_PREFIX + key],
+            args=[randint(0, 2 ** 31 - 1), 100, 85, 100, 1, 20]
+        )
+        if not proxy:
+            raise PoolEmptyException()
+        return self._bytes_to_str(proxy)
+
+    def z_random_get_many(self, key='baidu', n=1, weight=''):
+        """
+        pick n distinct proxies from the top tier and decrease each by 1, in a single round trip.
+        weight: '' for uniform, 'score' to prefer higher scores, 'latency' to prefer faster proxies
+        """
+        proxies = self._z_checkout_many_script(
+            keys=[key, LATENCY_PREFIX + key],
+            args=[randint(0, 2 ** 31 - 1), 100, 85, 100, 1, 20, n, weight]
+        )
+        if not proxies:
             raise PoolEmptyException()
+        return [self._bytes_to_str(i) for i in proxies]
+
+    def z_update_latency(self, key, latencies, failures=(), alpha=0.3, window=20, chunk_size=500):
+        """
+        latencies: dict of proxy -> latency in ms of a successful probe
+        failures: proxies whose latency is forgotten
+        """
+        items = list(latencies.items()) + [(p, '') for p in failures]
+        for chunk in _chunks(items, chunk_size):
+            args = [alpha, window]
+            for proxy, ms in chunk:
+                args.extend((proxy, ms))
+            self._latency_update_script(keys=[LATENCY_PREFIX + key], args=args)
+
+    def z_get_latency(self, key, proxy):
+        """
+        return: (ewma, p95) in ms, or None if the proxy has no successful probe recorded
+        """
+        value = self._client.hget(LATENCY_PREFIX + key, proxy)
+        if not value:
+            return None
+        ewma, p95, _ = self._bytes_to_str(value).split(';', 2)
+        return int(ewma), int(p95)
 
     def z_get_total_num(self, key, min_score=0, max_score=100, get_list=False):
         res = self._client.zrangebyscore(key, min_score, max_score)
@@ -156,3 +931,19 @@ class RedisPool(RedisPoolBase):
             return len(res)
         else:
             return [self._bytes_to_str(i) for i in res]
+
+    # ====================================
+    #  metrics of all processes
+    # ====================================
+    def push_metrics(self, field, value):
+        self._client.hset(METRICS_KEY, field, value)
+
+    def get_metrics(self):
+        """
+        return: dict of process id -> pushed json
+        """
+        return {self._bytes_to_str(k): v for k, v in self._client.hgetall(METRICS_KEY).items()}
+
+    def delete_metrics(self, fields):
+        if fields:
+            self._client.hdel(METRICS_KEY, *fields)
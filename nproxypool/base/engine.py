@@ -0,0 +1,187 @@
+# =============================================
+# multiplexed verifier engine
+# ---------------------------------------------
+# runs every [verifier_*] section in one event loop: verifiers reading the
+# same source share one SCAN pass per round, one aiohttp session and one
+# redis connection pool per db. Each proxy is fanned out to every verifier
+# of the round, and each verifier keeps its own max_worker workers, so its
+# concurrency is limited independently of the others.
+# Verifiers of a source run their rounds together, the smallest to_sleep among
+# them sets the pause between two rounds.
+# With schedule on, a verifier only gets the proxies of the pass that are due.
+# ==============================================
+import sys
+import signal
+import asyncio
+import traceback
+from itertools import groupby
+from nproxypool.base.logger import get_logger
+from nproxypool.base.verifier import Verifier, get_verifier_logger
+from nproxypool.base.metrics import start_pusher
+
+
+class VerifierEngine(object):
+    def __init__(self):
+        self._loop = asyncio.new_event_loop()
+        self._session = None
+        self._clients = {}
+        self._aio_clients = {}
+        self._targets = []
+        self._logger = None
+        self._main = None
+        self._tasks = set()
+
+    def init_engine(self, conf_list, log_file_path=None):
+        """
+        conf_list: kwargs of every verifier, as passed to run_verifier
+        """
+        self._logger = get_logger(
+            name='verifier_engine',
+            filename='verifier_engine.log',
+            filedir=log_file_path,
+            level='warning',
+            back_count=7
+        )
+        for conf in conf_list:
+            # one engine verifier covers the whole source, shards only apply to the process mode
+            conf = dict(conf, shards=1, shard=0)
+            v = Verifier()
+            v._loop.close()
+            v._loop = self._loop
+            v._clients = self._clients
+            v._aio_clients = self._aio_clients
+            v._logger = get_verifier_logger(conf.get('name', 'Default'), log_file_path,
+                                            log_level=conf.get('log_level', 'info'))
+            v.init_verifier(**conf)
+            source_id, make_source, on_results = v.prepare()
+            self._targets.append({
+                'verifier': v,
+                'source_id': source_id,
+                'make_source': make_source,
+                'on_results': on_results,
+                'to_sleep': conf.get('to_sleep', 10),
+                'next_run': 0,
+                'running': False
+            })
+
+    @staticmethod
+    async def _feed(buffer, queue):
+        """
+        move the batches buffered for one target into its bounded queue until None,
+        then wait for its workers to finish them.
+        """
+        while True:
+            batch = await buffer.get()
+            if batch is None:
+                break
+            for proxy in batch:
+                await queue.put(proxy)
+        await queue.join()
+
+    async def run_round(self, targets):
+        """
+        one SCAN pass of a shared source, fanned out to every target of the round.
+        every target is fed from its own buffer, so a slow target only back-pressures
+        its own queue and never the SCAN pass of the others.
+        """
+        buffers, feeders = [], []
+        for target in targets:
+            target['verifier']._session = self._session
+            queue = await target['verifier'].start_pipeline(target['on_results'])
+            buffers.append(asyncio.Queue())
+            feeders.append(self._loop.create_task(self._feed(buffers[-1], queue)))
+        producer = targets[0]['verifier']
+        source = targets[0]['make_source']()
+        try:
+            while True:
+                batch = await producer.next_batch(source)
+                if not batch:
+                    break
+                for target, buffer in zip(targets, buffers):
+                    buffer.put_nowait(await target['verifier'].select(batch))
+            for buffer in buffers:
+                buffer.put_nowait(None)
+            await asyncio.gather(*feeders)
+        finally:
+            for feeder in feeders:
+                feeder.cancel()
+            await asyncio.gather(*feeders, return_exceptions=True)
+            for target in targets:
+                await target['verifier'].stop_pipeline()
+
+    async def _run_round(self, targets):
+        _start = self._loop.time()
+        try:
+            await self.run_round(targets)
+        except Exception:
+            self._logger.error(str(traceback.format_exc()))
+        finally:
+            # targets of a source stay due together, so they keep sharing its SCAN pass
+            next_run = self._loop.time() + min(target['to_sleep'] for target in targets)
+            for target in targets:
+                target['verifier'].record_round(round(self._loop.time() - _start, 2))
+                target['running'] = False
+                target['next_run'] = next_run
+
+    async def run_forever(self):
+        limit = sum(t['verifier']._max_worker for t in self._targets)
+        self._session = self._targets[0]['verifier']._make_session(limit=limit)
+        try:
+            while True:
+                now = self._loop.time()
+                due = [t for t in self._targets if not t['running'] and t['next_run'] <= now]
+                due.sort(key=lambda t: t['source_id'])
+                for _, group in groupby(due, key=lambda t: t['source_id']):
+                    group = list(group)
+                    for target in group:
+                        target['running'] = True
+                    task = self._loop.create_task(self._run_round(group))
+                    self._tasks.add(task)
+                    task.add_done_callback(self._tasks.discard)
+                await asyncio.sleep(0.5)
+        finally:
+            await self._close_session()
+
+    async def _close_session(self):
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
+
+    def close(self):
+        """
+        cancel the main task and the rounds still running(their pipelines write back what they have),
+        then close the session, the redis clients and the loop.
+        """
+        tasks = [t for t in [self._main, *self._tasks] if t is not None and not t.done()]
+        for task in tasks:
+            task.cancel()
+        if tasks:
+            self._loop.run_until_complete(asyncio.gather(*tasks, return_exceptions=True))
+        self._loop.run_until_complete(self._close_session())
+        for client in self._aio_clients.values():
+            self._loop.run_until_complete(client.close())
+        self._aio_clients.clear()
+        self._loop.run_until_complete(self._loop.shutdown_asyncgens())
+        for client in self._clients.values():
+            client.close()
+        self._clients.clear()
+        self._loop.close()
+
+    def run(self, conf_list, log_file_path=None):
+        self.init_engine(conf_list, log_file_path=log_file_path)
+        try:
+            if self._targets:
+                self._main = self._loop.create_task(self.run_forever())
+                self._loop.run_until_complete(self._main)
+        finally:
+            self.close()
+
+
+def run_engine(conf_list, log_file_path=None, metrics=None):
+    """
+    metrics: optional params of start_pusher
+    """
+    if metrics:
+        start_pusher('verifier_engine', **metrics)
+    signal.signal(signal.SIGTERM, lambda sig_num, frame: sys.exit(0))
+    VerifierEngine().run(conf_list, log_file_path=log_file_path)
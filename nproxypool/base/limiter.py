@@ -0,0 +1,100 @@
+# =============================================
+# adaptive concurrency limit for verifiers
+# ---------------------------------------------
+# AIMD on windows of probe outcomes: the limit grows by sqrt(limit) after a
+# healthy window and is multiplied by decrease_factor after a congested one.
+# A window is congested when, compared with the slowly moving baselines,
+#   - the median latency of successful probes grows beyond latency_tolerance times,
+#   - or the timeout rate grows by more than timeout_tolerance,
+#   - or the error rate(status codes refused by the target) grows by more than error_tolerance.
+# Baselines absorb the steady share of dead proxies, so only a change of
+# those rates is read as congestion or rate-limiting.
+# ==============================================
+import math
+import asyncio
+
+
+class AdaptiveLimiter(object):
+    def __init__(self, min_limit, max_limit, window=50, latency_tolerance=2.0,
+                 timeout_tolerance=0.1, error_tolerance=0.05, decrease_factor=0.7, alpha=0.05):
+        self._min_limit = max(min_limit, 1)
+        self._max_limit = max(max_limit, self._min_limit)
+        self._limit = float(max(self._min_limit, self._max_limit // 2))
+        self._window = window
+        self._latency_tolerance = latency_tolerance
+        self._timeout_tolerance = timeout_tolerance
+        self._error_tolerance = error_tolerance
+        self._decrease_factor = decrease_factor
+        self._alpha = alpha
+        self._in_flight = 0
+        self._condition = None
+        self._latencies = []
+        self._timeouts = 0
+        self._errors = 0
+        self._samples = 0
+        self._baseline = None
+
+    @property
+    def limit(self):
+        return int(self._limit)
+
+    @property
+    def in_flight(self):
+        return self._in_flight
+
+    async def acquire(self):
+        if self._condition is None:
+            self._condition = asyncio.Condition()
+        async with self._condition:
+            await self._condition.wait_for(lambda: self._in_flight < self.limit)
+            self._in_flight += 1
+
+    async def release(self, latency=None, timeout=False, error=False):
+        """
+        latency: seconds of a successful probe, None for a failed one
+        timeout: the probe timed out
+        error: the target refused the probe, e.g. 403/429
+        """
+        self._in_flight -= 1
+        self._record(latency, timeout, error)
+        async with self._condition:
+            self._condition.notify_all()
+
+    def _record(self, latency, timeout, error):
+        self._samples += 1
+        if latency is not None:
+            self._latencies.append(latency)
+        self._timeouts += bool(timeout)
+        self._errors += bool(error)
+        if self._samples >= self._window:
+            self._adjust()
+            self._latencies = []
+            self._timeouts = self._errors = self._samples = 0
+
+    def _adjust(self):
+        latencies = sorted(self._latencies)
+        current = {
+            'latency': latencies[len(latencies) // 2] if latencies else None,
+            'timeout_rate': self._timeouts / self._samples,
+            'error_rate': self._errors / self._samples
+        }
+        if self._baseline is None:
+            self._baseline = current
+            return
+        congested = (
+            current['timeout_rate'] > self._baseline['timeout_rate'] + self._timeout_tolerance or
+            current['error_rate'] > self._baseline['error_rate'] + self._error_tolerance or
+            (current['latency'] is not None and self._baseline['latency'] is not None and
+             current['latency'] > self._baseline['latency'] * self._latency_tolerance)
+        )
+        if congested:
+            self._limit = max(self._min_limit, self._limit * self._decrease_factor)
+        else:
+            self._limit = min(self._max_limit, self._limit + math.sqrt(self._limit))
+        for k, v in current.items():
+            if v is None:
+                continue
+            if self._baseline[k] is None:
+                self._baseline[k] = v
+            else:
+                self._baseline[k] += self._alpha * (v - self._baseline[k])
@@ -1,4 +1,6 @@
 import os
+import queue
+import atexit
 import logging
 from logging import handlers, getLogger
 
@@ -26,9 +28,18 @@ class Logger(object):
         'critical': logging.CRITICAL
     }
 
-    def __init__(self, name='', filename=None, filedir=None, level='info', when='D', back_count=2, fmt=''):
+    def __init__(self, name='', filename=None, filedir=None, level='info', when='D', back_count=2, fmt='',
+                 console_level='info', queued=False):
+        """
+        level: level of the log file, only warnings and above are written to it
+        console_level: level of the console output
+        queued: emit records into a queue and let a listener thread format and write them,
+                so logging calls never block the caller on formatting or I/O
+        """
         self.logger = getLogger(name=name)
-        self.logger.setLevel(logging.INFO)
+        console_level = self.level_relations.get(console_level, logging.INFO)
+        self.logger.setLevel(min(console_level, logging.INFO))
+        _handlers = []
         if not fmt:
             fmt = '%(asctime)s - %(pathname)s[line:%(lineno)d] - %(levelname)s: %(message)s'
 
@@ -41,19 +52,28 @@ class Logger(object):
             f.setLevel(self.level_relations.get(level))
             filter_ = FileFilter()
             f.addFilter(filter_)
-            self.logger.addHandler(f)
+            _handlers.append(f)
 
         t = logging.StreamHandler()
-        t.setLevel(logging.INFO)
+        t.setLevel(console_level)
         t.setFormatter(format_str)
-        self.logger.addHandler(t)
+        _handlers.append(t)
+        if queued:
+            q = queue.SimpleQueue()
+            listener = handlers.QueueListener(q, *_handlers, respect_handler_level=True)
+            listener.start()
+            atexit.register(listener.stop)
+            _handlers = [handlers.QueueHandler(q)]
+        for h in _handlers:
+            self.logger.addHandler(h)
         logging.getLogger('apscheduler').setLevel(logging.WARNING)
 
     def __call__(self):
         return self.logger
 
 
-def get_logger(name='', filename=None, filedir=None, level='info', when='D', back_count=2, fmt=''):
+def get_logger(name='', filename=None, filedir=None, level='info', when='D', back_count=2, fmt='',
+               console_level='info', queued=False):
     _logger = Logger(
         name=name,
         filename=filename,
@@ -61,6 +81,8 @@ def get_logger(name='', filename=None, filedir=None, level='info', when='D', bac
         level=level,
         when=when,
         back_count=back_count,
-        fmt=fmt
+        fmt=fmt,
+        console_level=console_level,
+        queued=queued
     )()
     return _logger
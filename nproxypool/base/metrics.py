@@ -0,0 +1,263 @@
+# =============================================
+# metrics in the Prometheus text format
+# ---------------------------------------------
+# every process keeps its counters, gauges and histograms in REGISTRY.
+# Pool processes(verifiers, synchronizer, fetcher) and server workers push
+# a snapshot of it to the hash METRICS_KEY every push_interval seconds,
+# and /metrics of the server sums the fresh snapshots of all processes.
+# ==============================================
+import os
+import json
+import time
+import socket
+import bisect
+import threading
+import traceback
+from nproxypool.base.logger import get_logger
+
+# hash of process id -> json snapshot, in second-level pool
+METRICS_KEY = '__npool__:metrics'
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+logger = get_logger(name='metrics')
+# Redis operations are timed and counted while True, see disable_instrumentation()
+INSTRUMENTED = True
+
+
+def disable_instrumentation():
+    """
+    stop timing and counting the Redis operations of this process, for [metrics] enabled = false.
+    """
+    global INSTRUMENTED
+    INSTRUMENTED = False
+
+
+def _labels_key(labels):
+    """
+    a hashable key, serialised only by snapshot()
+    """
+    return tuple(sorted(labels.items()))
+
+
+class Metric(object):
+    type = ''
+
+    def __init__(self, name, doc, registry=None):
+        self.name = name
+        self.doc = doc
+        self._lock = threading.Lock()
+        self._samples = {}
+        (registry or REGISTRY).register(self)
+
+    def snapshot(self):
+        with self._lock:
+            samples = {json.dumps(key): value for key, value in self._samples.items()}
+            return {
+                'type': self.type,
+                'help': self.doc,
+                'samples': json.loads(json.dumps(samples))
+            }
+
+
+class Counter(Metric):
+    type = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = _labels_key(labels)
+        with self._lock:
+            self._samples[key] = self._samples.get(key, 0) + amount
+
+
+class Gauge(Metric):
+    type = 'gauge'
+
+    def set(self, value, **labels):
+        with self._lock:
+            self._samples[_labels_key(labels)] = value
+
+    def inc(self, amount=1, **labels):
+        key = _labels_key(labels)
+        with self._lock:
+            self._samples[key] = self._samples.get(key, 0) + amount
+
+    def dec(self, amount=1, **labels):
+        self.inc(-amount, **labels)
+
+
+class Histogram(Metric):
+    type = 'histogram'
+
+    def __init__(self, name, doc, buckets=DEFAULT_BUCKETS, registry=None):
+        self.buckets = tuple(buckets)
+        super(Histogram, self).__init__(name, doc, registry=registry)
+
+    def observe(self, value, **labels):
+        key = _labels_key(labels)
+        with self._lock:
+            sample = self._samples.get(key)
+            if sample is None:
+                sample = self._samples[key] = {'buckets': [0] * len(self.buckets), 'sum': 0, 'count': 0}
+            i = bisect.bisect_left(self.buckets, value)
+            if i < len(self.buckets):
+                sample['buckets'][i] += 1
+            sample['sum'] += value
+            sample['count'] += 1
+
+    def snapshot(self):
+        res = super(Histogram, self).snapshot()
+        res['le'] = list(self.buckets)
+        return res
+
+
+class Registry(object):
+    def __init__(self):
+        self._metrics = {}
+
+    def register(self, metric):
+        self._metrics[metric.name] = metric
+
+    def snapshot(self):
+        return {name: metric.snapshot() for name, metric in self._metrics.items()}
+
+
+REGISTRY = Registry()
+
+
+# ====================================
+#  cross-process aggregation
+# ====================================
+def merge(snapshots):
+    """
+    sum the samples of several snapshots, gauges included(e.g. the concurrency of all shards).
+    """
+    res = {}
+    for snapshot in snapshots:
+        for name, metric in snapshot.items():
+            merged = res.setdefault(name, dict(metric, samples={}))
+            for key, value in metric['samples'].items():
+                old = merged['samples'].get(key)
+                if old is None:
+                    merged['samples'][key] = json.loads(json.dumps(value))
+                elif metric['type'] == 'histogram':
+                    old['buckets'] = [a + b for a, b in zip(old['buckets'], value['buckets'])]
+                    old['sum'] += value['sum']
+                    old['count'] += value['count']
+                else:
+                    merged['samples'][key] = old + value
+    return res
+
+
+def _format_labels(labels, extra=()):
+    items = list(labels) + list(extra)
+    if not items:
+        return ''
+    return '{' + ','.join('{}="{}"'.format(k, str(v).replace('\\', '\\\\').replace('"', '\\"')) for k, v in items) + '}'
+
+
+def render(snapshot):
+    """
+    render a snapshot in the Prometheus text exposition format
+    """
+    lines = []
+    for name in sorted(snapshot):
+        metric = snapshot[name]
+        lines.append('# HELP {} {}'.format(name, metric['help']))
+        lines.append('# TYPE {} {}'.format(name, metric['type']))
+        for key, value in sorted(metric['samples'].items()):
+            labels = [tuple(i) for i in json.loads(key)]
+            if metric['type'] != 'histogram':
+                lines.append('{}{} {}'.format(name, _format_labels(labels), value))
+                continue
+            cumulative = 0
+            for le, count in zip(metric['le'], value['buckets']):
+                cumulative += count
+                lines.append('{}_bucket{} {}'.format(name, _format_labels(labels, [('le', le)]), cumulative))
+            lines.append('{}_bucket{} {}'.format(name, _format_labels(labels, [('le', '+Inf')]), value['count']))
+            lines.append('{}_sum{} {}'.format(name, _format_labels(labels), value['sum']))
+            lines.append('{}_count{} {}'.format(name, _format_labels(labels), value['count']))
+    return '\n'.join(lines) + '\n'
+
+
+def process_id(role):
+    return '{}:{}:{}'.format(role, socket.gethostname(), os.getpid())
+
+
+def dump(role):
+    return json.dumps({'ts': time.time(), 'role': role, 'metrics': REGISTRY.snapshot()})
+
+
+def load_fresh(values, max_age, now=None):
+    """
+    values: dict of process id -> pushed json
+    return: (snapshots no older than max_age, ids of the stale ones)
+    """
+    now = time.time() if now is None else now
+    fresh, stale = [], []
+    for field, value in values.items():
+        data = json.loads(value)
+        if now - data['ts'] <= max_age:
+            fresh.append(data['metrics'])
+        else:
+            stale.append(field)
+    return fresh, stale
+
+
+def collect(values, max_age):
+    """
+    values: dict of process id -> pushed json
+    return: (metrics of the fresh snapshots in the text format, ids of the stale ones)
+    """
+    fresh, stale = load_fresh(values, max_age)
+    return render(merge(fresh)), stale
+
+
+# ====================================
+#  API server
+# ====================================
+HTTP_REQUESTS = Counter('npool_http_requests_total', 'API requests by endpoint and status')
+HTTP_SECONDS = Histogram('npool_http_request_seconds', 'Duration of API requests by endpoint')
+POOL_EMPTY = Counter('npool_pool_empty_total', 'Checkouts failed on an empty key')
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+
+def observe_request(endpoint, status, duration):
+    HTTP_REQUESTS.inc(endpoint=endpoint, status=status)
+    HTTP_SECONDS.observe(duration, endpoint=endpoint)
+
+
+def observe_pool_empty(key, keys):
+    """
+    keys: the configured second-level keys, any other key requested is counted as 'other'
+          so clients can not create series at will
+    """
+    POOL_EMPTY.inc(key=key if key in keys else 'other')
+
+
+# ====================================
+#  push from pool processes
+# ====================================
+def start_pusher(role, interval=10, **kwargs):
+    """
+    push REGISTRY every interval seconds from a daemon thread
+    kwargs: redis params of second-level pool
+    """
+    from nproxypool.base.db import RedisPool
+    pool = RedisPool(**kwargs)
+    field = process_id(role)
+
+    def _push_forever():
+        failing = False
+        while True:
+            time.sleep(interval)
+            try:
+                pool.push_metrics(field, dump(role))
+            except Exception:
+                # once per failure streak, redis being down fails every push
+                if not failing:
+                    logger.warning('metrics push of {} failed: {}'.format(field, traceback.format_exc()))
+                failing = True
+            else:
+                failing = False
+
+    t = threading.Thread(target=_push_forever, daemon=True)
+    t.start()
+    return t
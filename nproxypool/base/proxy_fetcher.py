@@ -1,11 +1,144 @@
+import asyncio
+import aiohttp
+from functools import partial
 from abc import abstractmethod
+from user_agent import generate_user_agent
 from nproxypool.base.db import RedisPool
+from nproxypool.base.bloom import RecentlySeenFilter
 
 
 class ProxyFetcherBase(object):
     def __init__(self, **kwargs):
+        """
+        to_sleep, jitter, timeout and max_backoff of [fetcher] are the scheduling defaults,
+        a subclass may set its own _interval, _jitter, _timeout and _max_backoff after calling this.
+        """
         self._client = RedisPool(**kwargs)
+        self._interval = kwargs.get('to_sleep', 30)
+        self._jitter = kwargs.get('jitter', 0.1)
+        self._timeout = kwargs.get('timeout', 300)
+        self._max_backoff = kwargs.get('max_backoff', 3600)
 
     @abstractmethod
     def run(self):
         pass
+
+
+class AsyncProxyFetcherBase(ProxyFetcherBase):
+    """
+    subclasses implement fetch() as an async generator yielding proxies(or lists of proxies),
+    the framework batches them into pipelined inserts.
+    pages are requested with get()/get_many() through a session shared by all async fetchers.
+    """
+    def __init__(self, **kwargs):
+        super(AsyncProxyFetcherBase, self).__init__(**kwargs)
+        self._kwargs = kwargs
+        self._session = None
+        # with async_client on, every run inserts through its own AsyncRedisPool, closed when the run ends
+        self._async_client = kwargs.get('async_client', False)
+        self._time_out = 10
+        self._page_concurrency = 5
+        self._insert_batch = 500
+        self._user_agent = generate_user_agent(os='win')
+        # proxies yielded within the last seen_ttl seconds are skipped without touching Redis
+        self._seen = None
+        if kwargs.get('seen_ttl'):
+            self._seen = RecentlySeenFilter(
+                ttl=kwargs['seen_ttl'],
+                capacity=kwargs.get('seen_capacity', 100000)
+            )
+
+    @abstractmethod
+    def fetch(self):
+        """
+        async generator of proxies('ip:port') or lists of proxies
+        """
+        pass
+
+    async def get(self, url, **kwargs):
+        """
+        return: text of the page
+        """
+        kwargs.setdefault('timeout', aiohttp.ClientTimeout(self._time_out))
+        kwargs.setdefault('headers', {'user-agent': self._user_agent})
+        async with self._session.get(url, **kwargs) as r:
+            return await r.text()
+
+    async def get_many(self, urls, **kwargs):
+        """
+        get pages concurrently, at most page_concurrency at a time, yielding (url, text) as they complete.
+        a failed page yields (url, exception) instead.
+        """
+        semaphore = asyncio.Semaphore(self._page_concurrency)
+
+        async def _get(url):
+            async with semaphore:
+                try:
+                    return url, await self.get(url, **kwargs)
+                except Exception as e:
+                    return url, e
+
+        for future in asyncio.as_completed([_get(url) for url in urls]):
+            yield await future
+
+    def _get_inserter(self, loop):
+        """
+        return: (coroutine function inserting a batch of proxies, AsyncRedisPool to close or None)
+        """
+        source = type(self).__name__
+        if not self._async_client:
+            insert_many = partial(self._client.insert_many, source=source)
+
+            async def _insert(batch):
+                return await loop.run_in_executor(None, insert_many, batch)
+            return _insert, None
+        from nproxypool.base.aio_db import AsyncRedisPool
+        client = AsyncRedisPool(**self._kwargs)
+        return partial(client.insert_many, source=source), client
+
+    async def run_async(self, session=None):
+        """
+        consume fetch() and insert its proxies every insert_batch proxies.
+        return: {'proxies': number of proxies yielded, 'new': number inserted,
+                 'duplicates': number already in the pool or yielded twice, 'skipped': number seen recently}
+        """
+        insert_many, aio_client = self._get_inserter(asyncio.get_running_loop())
+        own_session = session is None
+        self._session = session or aiohttp.ClientSession()
+        batch = []
+        res = {'proxies': 0, 'new': 0, 'duplicates': 0, 'skipped': 0}
+        try:
+            async for item in self.fetch():
+                for proxy in [item] if isinstance(item, str) else item:
+                    if self._seen is not None and self._seen.contains(proxy):
+                        res['proxies'] += 1
+                        res['skipped'] += 1
+                    else:
+                        batch.append(proxy)
+                if len(batch) >= self._insert_batch:
+                    await self._insert(insert_many, batch, res)
+                    batch = []
+            if batch:
+                await self._insert(insert_many, batch, res)
+        finally:
+            if own_session:
+                await self._session.close()
+            self._session = None
+            if aio_client is not None:
+                await aio_client.close()
+        return res
+
+    async def _insert(self, insert_many, batch, res):
+        self._add_counts(res, await insert_many(batch))
+        # marked only once inserted, proxies of a failed batch are tried again on the next run
+        if self._seen is not None:
+            self._seen.add_many(batch)
+
+    @staticmethod
+    def _add_counts(res, counts):
+        for k, v in counts.items():
+            res[k] += v
+
+    def run(self):
+        return asyncio.run(self.run_async())
+
@@ -0,0 +1,127 @@
+# =============================================
+# fetcher scheduler
+# ---------------------------------------------
+# every fetcher runs in its own task on its own interval(+-jitter), so a slow
+# or hanging source never delays the others. A run exceeding its timeout is
+# abandoned, and failing runs back off exponentially up to max_backoff.
+# async fetchers share one session, sync fetchers run in executor threads.
+# The yield of every source(proxies per run, new ones, duplicate rate) is
+# reported periodically, to find sources not worth fetching.
+# ==============================================
+import time
+import random
+import asyncio
+import aiohttp
+import traceback
+from nproxypool.base.proxy_fetcher import AsyncProxyFetcherBase
+from nproxypool.base.metrics import Counter, Histogram
+
+FETCHER_RUNS = Counter('npool_fetcher_runs_total', 'Fetcher runs by result(ok, timeout, error)')
+FETCHER_PROXIES = Counter('npool_fetcher_proxies_total', 'Proxies yielded by fetchers, by kind(proxies, new, skipped)')
+FETCHER_RUN_SECONDS = Histogram('npool_fetcher_run_seconds', 'Duration of fetcher runs')
+
+
+class FetcherScheduler(object):
+    def __init__(self, fetchers, logger, max_fetchers=4, report_interval=300):
+        """
+        fetchers: ProxyFetcherBase instances, each scheduled by its own _interval, _jitter,
+                  _timeout and _max_backoff
+        max_fetchers: fetchers running at the same time at most
+        """
+        self._fetchers = fetchers
+        self._logger = logger
+        self._max_fetchers = max_fetchers
+        self._report_interval = report_interval
+        self._semaphore = None
+        self._session = None
+        self._stats = {
+            type(f).__name__: {
+                'runs': 0,
+                'failures': 0,
+                'timeouts': 0,
+                'proxies': 0,
+                'new': 0,
+                'skipped': 0,
+                'last_duration': 0
+            } for f in fetchers
+        }
+
+    async def run_once(self, fetcher):
+        """
+        return: counts of the run as returned by run_async, or by insert_many for sync fetchers(if returned)
+        """
+        if isinstance(fetcher, AsyncProxyFetcherBase):
+            return await fetcher.run_async(self._session)
+        # a sync run() may return the number of new proxies
+        res = await asyncio.get_running_loop().run_in_executor(None, fetcher.run)
+        return res if isinstance(res, dict) else {}
+
+    def _record(self, name, result, duration):
+        stats = self._stats[name]
+        stats['runs'] += 1
+        stats['last_duration'] = round(duration, 2)
+        FETCHER_RUN_SECONDS.observe(duration, fetcher=name)
+        if result is None:
+            return
+        for k in ('proxies', 'new', 'skipped'):
+            stats[k] += result.get(k, 0)
+            FETCHER_PROXIES.inc(result.get(k, 0), fetcher=name, kind=k)
+        self._logger.info('fetcher {}: {}'.format(name, result))
+
+    async def schedule(self, fetcher):
+        name = type(fetcher).__name__
+        failures = 0
+        while True:
+            _start = time.monotonic()
+            async with self._semaphore:
+                try:
+                    result = await asyncio.wait_for(self.run_once(fetcher), fetcher._timeout)
+                    failures = 0
+                    FETCHER_RUNS.inc(fetcher=name, result='ok')
+                except asyncio.TimeoutError:
+                    result = None
+                    failures += 1
+                    self._stats[name]['timeouts'] += 1
+                    FETCHER_RUNS.inc(fetcher=name, result='timeout')
+                    self._logger.error('fetcher {} timed out after {}s'.format(name, fetcher._timeout))
+                except Exception:
+                    result = None
+                    failures += 1
+                    self._stats[name]['failures'] += 1
+                    FETCHER_RUNS.inc(fetcher=name, result='error')
+                    self._logger.error(str(traceback.format_exc()))
+            self._record(name, result, time.monotonic() - _start)
+            delay = min(fetcher._interval * 2 ** failures, max(fetcher._max_backoff, fetcher._interval))
+            await asyncio.sleep(delay * random.uniform(1 - fetcher._jitter, 1 + fetcher._jitter))
+
+    def get_stats(self):
+        """
+        return: dict of fetcher name -> totals, with the new proxies per run
+                and the share of yielded proxies already in the pool
+        """
+        res = {}
+        for name, stats in self._stats.items():
+            stats = dict(stats)
+            stats['new_per_run'] = round(stats['new'] / stats['runs'], 2) if stats['runs'] else 0
+            stats['duplicate_rate'] = round(1 - stats['new'] / stats['proxies'], 4) if stats['proxies'] else None
+            res[name] = stats
+        return res
+
+    async def report_forever(self):
+        while True:
+            await asyncio.sleep(self._report_interval)
+            for name, stats in self.get_stats().items():
+                self._logger.warning('fetcher {} yield: {}'.format(name, stats))
+
+    async def run_forever(self):
+        self._semaphore = asyncio.Semaphore(self._max_fetchers)
+        async with aiohttp.ClientSession() as session:
+            self._session = session
+            await asyncio.gather(
+                self.report_forever(),
+                *[self.schedule(f) for f in self._fetchers]
+            )
+
+    def run(self):
+        if self._fetchers:
+            asyncio.run(self.run_forever())
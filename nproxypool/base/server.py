@@ -1,33 +1,72 @@
 import os
+import time
 import traceback
-from flask import Flask, request
+from flask import Flask, Response, g, request
 from flask_restful import Api, Resource
-from nproxypool.base.db import RedisPool
+from nproxypool.base.db import RedisPool, META_PREFIX
+from nproxypool.base.cache import HotCache
+from nproxypool.base import metrics
 from nproxypool.utils.exceptions import PoolEmptyException
-from nproxypool.utils.misc import get_sychronizer_config, get_redis_config
+from nproxypool.utils.misc import get_sychronizer_config, get_redis_config, get_server_config
+from nproxypool.utils.misc import get_metrics_config
 
 
 POOL = None
+CACHE = None
+MAX_BATCH = 100
+METRICS = None
+PUSHER = None
+# second-level keys of pool.cfg, the only ones used as metric labels
+KEYS = frozenset()
 
 
 def get_second_level_pool(dir):
     synch_config = get_sychronizer_config(dir)
     redis_config = get_redis_config(dir)
     redis_config['db'] = synch_config['second_db']
-    global POOL
+    server_config = get_server_config(dir)
+    global POOL, CACHE, MAX_BATCH
     POOL = RedisPool(**redis_config)
+    MAX_BATCH = server_config['max_batch']
+    if server_config['cache']:
+        CACHE = HotCache(POOL, **server_config['cache_options'])
+    global METRICS, KEYS
+    METRICS = get_metrics_config(dir)
+    if METRICS is None:
+        metrics.disable_instrumentation()
+    KEYS = frozenset(synch_config['second_db_keys'])
+
+
+def _get_batch_size(n):
+    return min(max(int(n), 1), MAX_BATCH)
 
 
 class GetProxyRandomly(Resource):
     """
     'key' is a key in second-level pool 
+    'n' checks out n distinct proxies at once, 'weight=score' prefers higher scores,
+    'weight=latency' prefers the faster of two random proxies for every pick
     """
     @staticmethod
     def get():
         key = request.args.get('key')
+        n = request.args.get('n')
+        weight = request.args.get('weight') if request.args.get('weight') in ('score', 'latency') else ''
         try:
-            if key:
-                proxy = POOL.z_random_get_one(key=key)
+            if key and key.startswith(META_PREFIX):
+                res = {
+                    'errMsg': 'invalid key: {}'.format(key)
+                }
+            elif key and n:
+                proxies = (CACHE or POOL).z_random_get_many(key=key, n=_get_batch_size(n), weight=weight)
+                res = {
+                    'proxies': proxies
+                }
+            elif key:
+                if weight == 'latency':
+                    proxy = (CACHE or POOL).z_random_get_many(key=key, weight=weight)[0]
+                else:
+                    proxy = (CACHE or POOL).z_random_get_one(key=key)
                 res = {
                     'proxy': proxy
                 }
@@ -36,6 +75,7 @@ class GetProxyRandomly(Resource):
                     'errMsg': 'please input a key'
                 }
         except PoolEmptyException:
+            metrics.observe_pool_empty(key, KEYS)
             res = {
                 'errMsg': 'proxy pool is empty: {}'.format(str(traceback.format_exc()))
             }
@@ -55,7 +95,7 @@ class GetProxyTotalNum(Resource):
         _min = 0 if (_min < 0 or _min > 100) else _min
         _max = 100 if (_max < _min or _max > 100) else _max
         res = {}
-        if bytes(_key, encoding='utf-8') in POOL.z_get_all_keys():
+        if _key and POOL.z_exists(_key):
             _total = POOL.z_get_total_num(_key, min_score=_min, max_score=_max)
             res[_key] = _total
         else:
@@ -72,7 +112,7 @@ class GetProxyList(Resource):
         _min = 0 if (_min < 0 or _min > 100) else _min
         _max = 100 if (_max < _min or _max > 100) else _max
         res = {}
-        if bytes(_key, encoding='utf-8') not in POOL.z_get_all_keys():
+        if not _key or not POOL.z_exists(_key):
             res['errMsg'] = 'invalid key: {}'.format(_key)
         else:
             _list = POOL.z_get_total_num(_key, min_score=_min, max_score=_max, get_list=True)
@@ -83,11 +123,44 @@ class GetProxyList(Resource):
         return res
 
 
-def make_app(dir):
-    get_second_level_pool(dir)
+def get_metrics():
+    """
+    metrics of this worker and of every process pushing to second-level pool
+    """
+    if not METRICS:
+        return Response(metrics.render(metrics.REGISTRY.snapshot()), content_type=metrics.CONTENT_TYPE)
+    POOL.push_metrics(metrics.process_id('server'), metrics.dump('server'))
+    text, stale = metrics.collect(POOL.get_metrics(), max_age=3 * METRICS['interval'])
+    POOL.delete_metrics(stale)
+    return Response(text, content_type=metrics.CONTENT_TYPE)
+
+
+def _before_request():
+    # the pusher is started in each worker, after the fork
+    global PUSHER
+    if METRICS and PUSHER is None:
+        PUSHER = metrics.start_pusher('server', **METRICS)
+    g.start = time.monotonic()
+
+
+def _after_request(response):
+    endpoint = request.url_rule.rule if request.url_rule else 'other'
+    metrics.observe_request(endpoint, response.status_code, time.monotonic() - g.start)
+    return response
+
+
+def create_app():
     app = Flask(__name__)
     api = Api(app=app)
     api.add_resource(GetProxyRandomly, '/proxy/random/')
     api.add_resource(GetProxyTotalNum, '/proxy/total/')
     api.add_resource(GetProxyList, '/proxy/list/')
+    app.add_url_rule('/metrics', 'metrics', get_metrics)
+    app.before_request(_before_request)
+    app.after_request(_after_request)
     return app
+
+
+def make_app(dir):
+    get_second_level_pool(dir)
+    return create_app()
@@ -0,0 +1,55 @@
+# =============================================
+# aggregation of per-shard verifier stats
+# ---------------------------------------------
+# every shard process puts the stats of its last round into a
+# multiprocessing queue, the parent process drains the queue and
+# reports the totals of each verifier.
+# ==============================================
+import time
+from queue import Empty
+
+
+class ShardStats(object):
+    def __init__(self, logger, report_interval=60):
+        self._logger = logger
+        self._report_interval = report_interval
+        self._last_report = time.monotonic()
+        self._latest = {}
+
+    def update(self, stats):
+        self._latest[(stats['name'], stats['shard'])] = stats
+
+    def drain(self, queue):
+        while True:
+            try:
+                self.update(queue.get_nowait())
+            except Empty:
+                break
+
+    def aggregate(self):
+        """
+        return: dict of verifier name -> totals over the last round of each shard
+        """
+        totals = {}
+        for (name, _), stats in sorted(self._latest.items()):
+            total = totals.setdefault(name, {
+                'shards_reported': 0,
+                'shards': stats['shards'],
+                'probes': 0,
+                'successes': 0,
+                'failures': 0,
+                'probes_per_second': 0,
+                'concurrency': 0
+            })
+            total['shards_reported'] += 1
+            for k in ('probes', 'successes', 'failures', 'probes_per_second', 'concurrency'):
+                total[k] += stats[k]
+        return totals
+
+    def report(self):
+        now = time.monotonic()
+        if now - self._last_report < self._report_interval:
+            return
+        self._last_report = now
+        for name, total in self.aggregate().items():
+            self._logger.info('verifier {}: {}'.format(name, total))
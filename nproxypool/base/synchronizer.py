@@ -1,18 +1,33 @@
 # ========================================================
 # automatically remove proxies exist in second-level pools
 # but not in the first-level one
+# --------------------------------------------------------
+# mode 'poll': a full diff every to_sleep seconds.
+# mode 'event': proxies are removed as soon as they expire or are deleted
+# from first-level pool(keyspace notifications), the full diff runs every
+# full_sync_to_sleep seconds only as a safety net.
 # ========================================================
 import time
+import threading
 import traceback
-from nproxypool.base.db import RedisPool
+from nproxypool.base.db import RedisPool, META_PREFIX
+from nproxypool.base.metrics import Counter, Gauge, start_pusher
 from nproxypool.base.logger import get_logger
 
+SYNC_REMOVED = Counter('npool_sync_removed_total', 'Proxies removed from second-level keys by mode')
+SYNC_SECONDS = Gauge('npool_sync_seconds', 'Duration of the last full sync')
+FIRST_LEVEL_SIZE = Gauge('npool_first_level_proxies', 'Proxies in first-level pool at the last full sync')
+POOL_SIZE = Gauge('npool_pool_proxies', 'Proxies in a second-level key at the last full sync')
+
 
 class Synchronizer(object):
     def __init__(self):
         self._first_level_pool = None
         self._second_level_pool = None
         self._second_level_pool_keys = []
+        self._scan_count = 1000
+        self._chunk_size = 500
+        self._event_flush_interval = 0.1
 
     def init_sync(self, **kwargs):
         host = kwargs.get('host', 'localhost')
@@ -21,6 +36,8 @@ class Synchronizer(object):
         first_db = kwargs.get('first_db', 0)
         second_db = kwargs.get('second_db', 1)
         second_db_keys = kwargs.get('second_db_keys', [])
+        self._scan_count = kwargs.get('scan_count', 1000)
+        self._chunk_size = kwargs.get('chunk_size', 500)
 
         first_db_param = {
             'host': host,
@@ -39,20 +56,80 @@ class Synchronizer(object):
         self._second_level_pool = RedisPool(**second_db_param)
 
     def synchronize(self, **kwargs):
+        """
+        remove proxies missing from first-level pool: one SCAN pass into a set,
+        one ZSCAN pass per key, stale proxies removed by chunked ZREM.
+        """
         self.init_sync(**kwargs)
-        first_level_pool_proxies = self._first_level_pool.get_all()
+        _start = time.monotonic()
+        first_level_pool_proxies = set(self._first_level_pool.iter_all(count=self._scan_count))
+        FIRST_LEVEL_SIZE.set(len(first_level_pool_proxies))
         for key in self._second_level_pool_keys:
-            proxies_in_second_key = self._second_level_pool.z_get_all(key)
-            for proxy in proxies_in_second_key:
+            removed = 0
+            total = 0
+            stale = []
+            for proxy in self._second_level_pool.z_iter(key, count=self._scan_count):
+                total += 1
                 if proxy not in first_level_pool_proxies:
-                    if isinstance(proxy, bytes):
-                        proxy = str(proxy, encoding='utf-8')
-                    print("!!!remove proxy: {}".format(proxy))
-                    self._second_level_pool.z_delete(proxy, key)
+                    stale.append(proxy)
+                    if len(stale) >= self._chunk_size:
+                        removed += self._second_level_pool.z_delete_many(key, stale)
+                        stale = []
+            removed += self._second_level_pool.z_delete_many(key, stale)
+            SYNC_REMOVED.inc(removed, mode='full')
+            POOL_SIZE.set(total - removed, key=key)
+            if removed:
+                print("!!!remove {} proxies from {}".format(removed, key))
+                self._second_level_pool.z_bump_version(key)
+        SYNC_SECONDS.set(round(time.monotonic() - _start, 2))
+
+    def listen(self, **kwargs):
+        """
+        subscribe to expired/del events of first-level pool and remove those proxies
+        from every second-level key, in chunks collected for at most event_flush_interval seconds.
+        """
+        self.init_sync(**kwargs)
+        try:
+            self._first_level_pool.enable_key_events()
+        except Exception:
+            print("!!!cannot enable keyspace notifications, set notify-keyspace-events to 'Egx' on the server")
+        pubsub = self._first_level_pool.subscribe_key_events()
+        prefix = META_PREFIX.encode()
+        try:
+            while True:
+                stale = set()
+                deadline = time.monotonic() + self._event_flush_interval
+                while len(stale) < self._chunk_size:
+                    timeout = deadline - time.monotonic()
+                    if timeout <= 0:
+                        break
+                    message = pubsub.get_message(timeout=timeout)
+                    if message and message['type'] == 'message' and not message['data'].startswith(prefix):
+                        stale.add(message['data'])
+                removed = self._second_level_pool.z_delete_from_keys(self._second_level_pool_keys, list(stale))
+                for key, num in removed.items():
+                    SYNC_REMOVED.inc(num, mode='event')
+                    if num:
+                        print("!!!remove {} proxies from {}".format(num, key))
+        finally:
+            pubsub.close()
+
+
+def listen_forever(logger, **kwargs):
+    while True:
+        try:
+            Synchronizer().listen(**kwargs)
+        except:
+            logger.error(str(traceback.format_exc()))
+        time.sleep(1)
 
 
 def sync(**kwargs):
+    mode = kwargs.get('mode', 'poll')
     to_sleep = kwargs.get('to_sleep', 300)
+    metrics = kwargs.pop('metrics', None)
+    if metrics:
+        start_pusher('synchronizer', **metrics)
     file_dir = kwargs.get('log_file_path')
     logger = get_logger(
         name='synchronizer',
@@ -61,6 +138,11 @@ def sync(**kwargs):
         level='warning',
         back_count=7
     )
+    if mode == 'event':
+        to_sleep = kwargs.get('full_sync_to_sleep', 3600)
+        t = threading.Thread(target=listen_forever, args=(logger,), kwargs=kwargs)
+        t.daemon = True
+        t.start()
     while True:
         try:
             s = Synchronizer()
@@ -4,12 +4,29 @@
 import time
 import asyncio
 import aiohttp
+import re
+import sys
+import signal
+import logging
+import zlib
+import inspect
 import traceback
+from functools import partial
+from itertools import islice
 from lxml import etree
 from abc import abstractmethod
 from user_agent import generate_user_agent
 from nproxypool.base.logger import get_logger
 from nproxypool.base.db import RedisPool
+from nproxypool.base.limiter import AdaptiveLimiter
+from nproxypool.base.metrics import Counter, Gauge, Histogram, start_pusher
+from nproxypool.utils.exceptions import StatusCodeError, ProbeAssertionError
+
+PROBES = Counter('npool_verifier_probes_total', 'Probes by verifier and result(success, timeout, error, failure)')
+PROBE_SECONDS = Histogram('npool_verifier_probe_seconds', 'Duration of successful probes')
+ROUNDS = Counter('npool_verifier_rounds_total', 'Rounds finished')
+ROUND_SECONDS = Gauge('npool_verifier_round_seconds', 'Duration of the last round')
+CONCURRENCY = Gauge('npool_verifier_concurrency', 'Concurrency limit at the end of the last round')
 
 
 class Base(object):
@@ -19,16 +36,102 @@ class Base(object):
         self._time_out = 5
         self._max_worker = 20
         self._status_code_allowed = [200, 302, 303]
+        self._conn_limit = 100
+        self._conn_limit_per_host = 0
+        self._dns_cache_ttl = 300
+        self._keepalive_timeout = 30
         self._loop = asyncio.new_event_loop()
-        self._failure_list = []
-        self._success_list = []
+        self._session = None
+        self._scan_count = 1000
+        self._queue_size = 0
+        self._flush_size = 500
+        self._flush_interval = 1000
+        self._queue = None
+        self._results = None
+        self._sink = None
+        self._tasks = []
+        self._own_session = True
+        self._shards = 1
+        self._shard = 0
+        self._adaptive = False
+        self._min_worker = 5
+        self._limiter = None
+        self._probe_mode = 'full'
+        self._probe_max_bytes = 4096
+        self._probe_assert = None
+        self._schedule = False
+        self._stats = self._new_stats()
         self._logger = None
+        self._log_probes = False
         self._os_type = {
             True: "android",
             False: ("mac", "win")
         }
 
-    async def requests(self, method, url=None, is_mobile=False, **kwargs):
+    # ====================================
+    #  shared session and timing traces
+    # ====================================
+    @staticmethod
+    async def _on_request_start(session, ctx, params):
+        if ctx.trace_request_ctx is not None:
+            ctx.trace_request_ctx['start'] = time.monotonic()
+
+    @staticmethod
+    async def _on_connection_create_start(session, ctx, params):
+        if ctx.trace_request_ctx is not None:
+            ctx.trace_request_ctx['conn_start'] = time.monotonic()
+
+    @staticmethod
+    async def _on_connection_create_end(session, ctx, params):
+        if ctx.trace_request_ctx is not None:
+            ctx.trace_request_ctx['conn_end'] = time.monotonic()
+
+    @staticmethod
+    async def _on_connection_reuseconn(session, ctx, params):
+        if ctx.trace_request_ctx is not None:
+            ctx.trace_request_ctx['conn_end'] = time.monotonic()
+
+    @staticmethod
+    async def _on_request_end(session, ctx, params):
+        """
+        handshake: time spent on opening a new connection(tcp, CONNECT and tls), 0 for a reused one
+        ttfb: time from a ready connection to the response headers
+        """
+        timing = ctx.trace_request_ctx
+        if timing is None:
+            return
+        end = time.monotonic()
+        conn_end = timing.get('conn_end', timing.get('start', end))
+        conn_start = timing.get('conn_start', conn_end)
+        timing['handshake'] = round(conn_end - conn_start, 3)
+        timing['ttfb'] = round(end - conn_end, 3)
+
+    def _make_session(self, limit=None):
+        """
+        must be called inside the running loop.
+        limit: total connections, defaults to conn_limit
+        connections are kept alive per proxy, so a proxy checked more than once
+        in the lifetime of the session skips the handshake.
+        """
+        connector = aiohttp.TCPConnector(
+            limit=self._conn_limit if limit is None else limit,
+            limit_per_host=self._conn_limit_per_host,
+            use_dns_cache=True,
+            ttl_dns_cache=self._dns_cache_ttl,
+            keepalive_timeout=self._keepalive_timeout
+        )
+        trace_config = aiohttp.TraceConfig()
+        trace_config.on_request_start.append(self._on_request_start)
+        trace_config.on_connection_create_start.append(self._on_connection_create_start)
+        trace_config.on_connection_create_end.append(self._on_connection_create_end)
+        trace_config.on_connection_reuseconn.append(self._on_connection_reuseconn)
+        trace_config.on_request_end.append(self._on_request_end)
+        return aiohttp.ClientSession(connector=connector, trace_configs=[trace_config])
+
+    async def requests(self, method, url=None, is_mobile=False, probe=False, **kwargs):
+        """
+        probe: check liveness only, according to probe_mode, instead of reading and parsing the body
+        """
         kwargs.setdefault('timeout', aiohttp.ClientTimeout(self._time_out))
         if "headers" in kwargs:
             kwargs["headers"].setdefault("user-agent", generate_user_agent(os=self._os_type[is_mobile]))
@@ -36,53 +139,243 @@ class Base(object):
             kwargs["headers"] = {
                 "user-agent": generate_user_agent(os=self._os_type[is_mobile])
             }
-        async with aiohttp.ClientSession() as session:
-            async with session.request(method, url, **kwargs) as r:
-                resp = r
-                content_type = r.content_type
-                if "text" in content_type or "html" in content_type:
-                    content = await r.text(encoding=r.charset)
-                    resp.xpath = etree.HTML(content).xpath
-                elif "json" in content_type:
-                    content = await r.json(encoding=r.charset)
-                else:
-                    content = await r.read()
-                if r.status not in self._status_code_allowed:
-                    self._logger.info('STATUS_CODE_NOT_ALLOWED ERROR')
-                    raise Exception('!STATUS CODE ERROR!')
+        _request = self._probe if probe else self._request
+        if self._session is None:
+            async with aiohttp.ClientSession() as session:
+                return await _request(session, method, url, **kwargs)
+        return await _request(self._session, method, url, **kwargs)
+
+    async def _probe(self, session, method, url, **kwargs):
+        """
+        probe_mode:
+            full: read and parse the whole body, as _request does
+            status, head: status code only, the body is never read(head sends HEAD)
+            bytes: read at most probe_max_bytes of the body
+        the bytes read are checked against probe_assert, if any.
+        """
+        if self._probe_mode == 'full':
+            return await self._request(session, method, url, **kwargs)
+        async with session.request(method, url, **kwargs) as r:
+            if r.status not in self._status_code_allowed:
+                raise StatusCodeError(r.status)
+            content = b''
+            if self._probe_mode == 'bytes':
+                while len(content) < self._probe_max_bytes:
+                    chunk = await r.content.read(self._probe_max_bytes - len(content))
+                    if not chunk:
+                        break
+                    content += chunk
+                if self._probe_assert and not self._probe_assert.search(content):
+                    raise ProbeAssertionError()
+        return content, r
+
+    async def _request(self, session, method, url, **kwargs):
+        async with session.request(method, url, **kwargs) as r:
+            resp = r
+            content_type = r.content_type
+            if "text" in content_type or "html" in content_type:
+                content = await r.text(encoding=r.charset)
+                resp.xpath = etree.HTML(content).xpath
+            elif "json" in content_type:
+                content = await r.json(encoding=r.charset)
+            else:
+                content = await r.read()
+            if r.status not in self._status_code_allowed:
+                self._logger.debug('STATUS_CODE_NOT_ALLOWED ERROR')
+                raise StatusCodeError(r.status)
         return content, resp
 
-    async def verify_worker(self, worker_name, queue):
+    async def verify_worker(self, worker_name, queue, results):
         while True:
             proxy = await queue.get()
             _proxy = 'http://{}'.format(proxy) if not proxy.startswith('http') else proxy
+            timing = {}
+            latency, timeout, error = None, False, False
+            if self._limiter:
+                await self._limiter.acquire()
             try:
                 _start = time.monotonic()
-                await self.requests('GET', self._url, proxy=_proxy)
-                _time_consumed = round(time.monotonic() - _start, 2)
-                self._logger.info(f'>>>{worker_name}-ip: {_proxy}, time_consumed: {_time_consumed}')
-                self._success_list.append(proxy)
-            except:
-                self._failure_list.append(proxy)
-                self._logger.info(f'!!!{worker_name}-ip: {_proxy}, FAILED')
+                method = 'HEAD' if self._probe_mode == 'head' else 'GET'
+                await self.requests(method, self._url, proxy=_proxy, trace_request_ctx=timing, probe=True)
+                latency = time.monotonic() - _start
+                if self._log_probes:
+                    self._logger.debug(
+                        f'>>>{worker_name}-ip: {_proxy}, time_consumed: {round(latency, 2)}, '
+                        f'handshake: {timing.get("handshake")}, ttfb: {timing.get("ttfb")}'
+                    )
+                results.put_nowait((proxy, True, latency))
+                self._stats['successes'] += 1
+                self._stats['latency'] += latency
+                PROBES.inc(verifier=self._name, result='success')
+                PROBE_SECONDS.observe(latency, verifier=self._name)
+            except Exception as e:
+                timeout = isinstance(e, asyncio.TimeoutError)
+                error = isinstance(e, (StatusCodeError, ProbeAssertionError))
+                results.put_nowait((proxy, False, None))
+                self._stats['failures'] += 1
+                result = 'timeout' if timeout else 'error' if error else 'failure'
+                if timeout or error:
+                    self._stats[result + 's'] += 1
+                PROBES.inc(verifier=self._name, result=result)
+                if self._log_probes:
+                    self._logger.debug(f'!!!{worker_name}-ip: {_proxy}, FAILED: {result} {e!r}')
+            finally:
+                if self._limiter:
+                    await self._limiter.release(latency, timeout=timeout, error=error)
+            self._stats['probes'] += 1
             queue.task_done()
 
-    async def verify(self, proxy_list):
-        queue = asyncio.Queue()
+    def _in_shard(self, proxy):
+        """
+        proxies are partitioned among shards by a stable hash of the proxy string.
+        """
+        return self._shards <= 1 or zlib.crc32(proxy.encode()) % self._shards == self._shard
+
+    def _select(self, batch):
+        """
+        proxies of a batch owned by this shard and due for verification.
+        """
+        return [p for p in batch if self._in_shard(p)]
+
+    def _next_batch(self, source):
+        return [self._to_str(p) for p in islice(source, self._scan_count)]
+
+    @staticmethod
+    def _to_str(proxy):
+        return proxy.decode() if isinstance(proxy, bytes) else proxy
+
+    async def next_batch(self, source):
+        """
+        next SCAN batch of an async iterator, or of a blocking one read off the loop thread.
+        """
+        if not hasattr(source, '__anext__'):
+            return await self._loop.run_in_executor(None, self._next_batch, source)
+        batch = []
+        async for proxy in source:
+            batch.append(self._to_str(proxy))
+            if len(batch) >= self._scan_count:
+                break
+        return batch
+
+    async def select(self, batch):
+        return await self._loop.run_in_executor(None, self._select, batch)
+
+    async def produce(self, source, queue):
+        """
+        feed proxies from a SCAN iterator into the bounded queue, one SCAN batch at a time.
+        """
+        while True:
+            batch = await self.next_batch(source)
+            if not batch:
+                break
+            for proxy in await self.select(batch):
+                await queue.put(proxy)
 
-        for _proxy in proxy_list:
-            proxy = _proxy.decode()
-            queue.put_nowait(proxy)
+    async def result_sink(self, results, on_results):
+        """
+        hand results to on_results(successes, failures, latencies) every flush_size results
+        or every flush_interval milliseconds, until a None is received.
+        a coroutine on_results is awaited in the loop, a blocking one runs off the loop thread.
+        latencies: dict of proxy -> seconds taken by each successful probe
+        """
+        is_async = inspect.iscoroutinefunction(getattr(on_results, 'func', on_results))
+        done = False
+        while not done:
+            successes, failures, latencies = [], [], {}
+            deadline = self._loop.time() + self._flush_interval / 1000
+            while len(successes) + len(failures) < self._flush_size:
+                timeout = deadline - self._loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    item = await asyncio.wait_for(results.get(), timeout)
+                except asyncio.TimeoutError:
+                    break
+                if item is None:
+                    done = True
+                    break
+                proxy, ok, latency = item
+                (successes if ok else failures).append(proxy)
+                if ok:
+                    latencies[proxy] = latency
+            if successes or failures:
+                try:
+                    if is_async:
+                        await on_results(successes, failures, latencies)
+                    else:
+                        await self._loop.run_in_executor(None, on_results, successes, failures, latencies)
+                except Exception:
+                    self._logger.error(str(traceback.format_exc()))
 
-        tasks = []
+    async def start_pipeline(self, on_results):
+        """
+        start the workers and the result sink, uses self._session if one is shared with this verifier.
+        stats are reset here, so they cover one round.
+        return: the bounded queue to feed proxies into
+        """
+        self._stats = self._new_stats()
+        self._log_probes = self._logger.isEnabledFor(logging.DEBUG)
+        self._queue = asyncio.Queue(maxsize=self._queue_size or self._max_worker * 2)
+        self._results = asyncio.Queue()
+        if self._adaptive and self._limiter is None:
+            self._limiter = AdaptiveLimiter(self._min_worker, self._max_worker)
+        self._own_session = self._session is None
+        if self._own_session:
+            self._session = self._make_session()
+        self._sink = self._loop.create_task(self.result_sink(self._results, on_results))
+        self._tasks = []
         for i in range(self._max_worker):
-            task = self._loop.create_task(self.verify_worker(f'{self._name}-{i}', queue))
-            tasks.append(task)
+            task = self._loop.create_task(self.verify_worker(f'{self._name}-{i}', self._queue, self._results))
+            self._tasks.append(task)
+        return self._queue
 
-        await queue.join()
-        for task in tasks:
+    async def stop_pipeline(self):
+        """
+        stop the workers, then wait for the sink to write back the last results.
+        """
+        for task in self._tasks:
             task.cancel()
-        await asyncio.gather(*tasks, return_exceptions=True)
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._results.put_nowait(None)
+        await self._sink
+        if self._own_session:
+            await self._session.close()
+            self._session = None
+
+    async def verify(self, source, on_results):
+        """
+        streaming pipeline: producer -> bounded queue -> workers -> result sink.
+        source: iterator of proxies, e.g. a SCAN iterator
+        on_results: callable(successes, failures, latencies) writing a batch of results back
+        """
+        queue = await self.start_pipeline(on_results)
+        try:
+            await self.produce(source, queue)
+            await queue.join()
+        finally:
+            await self.stop_pipeline()
+
+    async def _close_session(self):
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
+
+    def close(self):
+        """
+        close the session and the loop, the verifier can not run afterwards.
+        """
+        if self._loop.is_closed():
+            return
+        self._loop.run_until_complete(self._close_session())
+        self._loop.run_until_complete(self._loop.shutdown_asyncgens())
+        self._loop.close()
+
+    @staticmethod
+    def _new_stats():
+        """
+        latency: sum of the latencies of successful probes
+        """
+        return {'probes': 0, 'successes': 0, 'failures': 0, 'timeouts': 0, 'errors': 0, 'latency': 0}
 
     @abstractmethod
     def init_verifier(self, **kwargs):
@@ -99,6 +392,7 @@ class Verifier(Base):
         self._redis_host = ''
         self._redis_port = ''
         self._password = ''
+        self._layout = 'string'
         self._from_db = 0
         self._from_db_key = ''
         self._is_from_db_zset = False
@@ -107,6 +401,16 @@ class Verifier(Base):
         self._is_to_db_zset = False
         self._score_threshold = 30
         self._score_decrease_by = 30
+        self._batch_size = 500
+        self._min_interval = 60
+        self._max_interval = 1800
+        self._latency_window = 20
+        self._clients = {}
+        self._aio_clients = {}
+        self._async_client = False
+        self._make_source = None
+        self._on_results = None
+        self._round = None
         self._redis_uri = "redis://:{password}@{host}:{port}/{db}"
 
     def init_verifier(self, **kwargs):
@@ -116,6 +420,8 @@ class Verifier(Base):
         self._redis_host = kwargs['host']
         self._redis_port = kwargs['port']
         self._password = kwargs['password']
+        self._layout = kwargs.get('layout', 'string')
+        self._async_client = kwargs.get('async_client', False)
         self._name = kwargs.get('name', 'Default')
         self._url = kwargs.get('url', 'https://feed.baidu.com/feed/api/tab/gettabinfo')
         self._max_worker = kwargs.get('max_worker', 20)
@@ -128,155 +434,349 @@ class Verifier(Base):
         self._is_to_db_zset = kwargs.get('is_to_db_zset', False)
         self._score_threshold = kwargs.get('score_threshold', 30)
         self._score_decrease_by = kwargs.get('score_decrease_by', 30)
+        self._conn_limit = kwargs.get('conn_limit', 100)
+        self._conn_limit_per_host = kwargs.get('conn_limit_per_host', 0)
+        self._dns_cache_ttl = kwargs.get('dns_cache_ttl', 300)
+        self._keepalive_timeout = kwargs.get('keepalive_timeout', 30)
+        self._batch_size = kwargs.get('batch_size', 500)
+        self._scan_count = kwargs.get('scan_count', 1000)
+        self._queue_size = kwargs.get('queue_size', 0)
+        self._flush_size = kwargs.get('flush_size', 500)
+        self._flush_interval = kwargs.get('flush_interval', 1000)
+        self._shards = kwargs.get('shards', 1)
+        self._shard = kwargs.get('shard', 0)
+        self._adaptive = kwargs.get('adaptive', False)
+        self._min_worker = kwargs.get('min_worker', 5)
+        self._probe_mode = kwargs.get('probe_mode', 'full')
+        self._probe_max_bytes = kwargs.get('probe_max_bytes', 4096)
+        self._probe_assert = self._compile_assert(kwargs.get('probe_assert', ''))
+        if self._probe_assert and self._probe_mode != 'bytes':
+            # the other modes never check the body, the assertion would be silently skipped
+            raise ValueError('verifier {}: probe_assert requires probe_mode = bytes, not {}'.format(
+                self._name, self._probe_mode))
+        self._schedule = kwargs.get('schedule', False)
+        self._min_interval = kwargs.get('min_interval', 60)
+        self._max_interval = kwargs.get('max_interval', 1800)
+        self._latency_window = kwargs.get('latency_window', 20)
 
-    def _delete_or_decrease(self, proxy: str, client: RedisPool, zset_key: str = ''):
+    @staticmethod
+    def _compile_assert(probe_assert):
         """
-        Delete a proxy or decrease its score.
+        're:<pattern>' is a regex, anything else a plain substring.
         """
+        if not probe_assert:
+            return None
+        if probe_assert.startswith('re:'):
+            return re.compile(probe_assert[3:].encode('utf-8'))
+        return re.compile(re.escape(probe_assert.encode('utf-8')))
 
+    async def _update_async(self, client, successes: list, failures: list, latencies: dict = None,
+                            zset_key: str = ''):
+        """
+        same as _update on an AsyncRedisPool, from inside the loop.
+        """
+        latencies = {p: round(t * 1000) for p, t in (latencies or {}).items()}
         if not zset_key:
-            value = client.get_one(proxy)
-            if value:
-                _, score = value.split(';')
-                new_score = int(score) - self._score_decrease_by
-                if new_score <= self._score_threshold:
-                    client.delete_one(proxy)
-                else:
-                    client.update_one(
-                        proxy,
-                        new_score,
-                        old_value=value
-                    )
-            else:
-                client.z_decrease(
-                    proxy,
-                    zset_key,
-                    score_threshold=self._score_threshold,
-                    to_decr=self._score_decrease_by
-                )
+            await client.update_many(
+                successes,
+                failures,
+                score_threshold=self._score_threshold,
+                to_decr=self._score_decrease_by,
+                chunk_size=self._batch_size,
+                latencies=latencies
+            )
+        else:
+            await client.z_update_many(
+                zset_key,
+                successes,
+                failures,
+                score_threshold=self._score_threshold,
+                to_decr=self._score_decrease_by,
+                chunk_size=self._batch_size
+            )
+            await client.z_update_latency(
+                zset_key,
+                latencies,
+                failures,
+                window=self._latency_window,
+                chunk_size=self._batch_size
+            )
+        if self._schedule:
+            await client.schedule_many(
+                self._name,
+                successes,
+                failures,
+                min_interval=self._min_interval,
+                max_interval=self._max_interval,
+                chunk_size=self._batch_size
+            )
 
-    def _insert_or_increase(self, proxy: str, client: RedisPool, zset_key: str = ''):
+    def _update(self, client: RedisPool, successes: list, failures: list, latencies: dict = None,
+                zset_key: str = ''):
         """
-        Insert a proxy or increase its score.
+        Write back a batch of results, chunked into one script call per batch_size proxies.
+        latencies are kept in packed records of first-level pool, and per second-level key.
         """
+        latencies = {p: round(t * 1000) for p, t in (latencies or {}).items()}
         if not zset_key:
-            value = client.get_one(proxy)
-            if value:
-                client.update_one(
-                    proxy,
-                    score=100,
-                    old_value=value
-                )
-            else:
-                client.insert_one(
-                    proxy,
-                    score=60
-                )
+            client.update_many(
+                successes,
+                failures,
+                score_threshold=self._score_threshold,
+                to_decr=self._score_decrease_by,
+                chunk_size=self._batch_size,
+                latencies=latencies
+            )
         else:
-            client.z_increase(
-                proxy,
-                zset_key
+            client.z_update_many(
+                zset_key,
+                successes,
+                failures,
+                score_threshold=self._score_threshold,
+                to_decr=self._score_decrease_by,
+                chunk_size=self._batch_size
             )
-
-    def _update(self, client: RedisPool, zset_key: str = ''):
-        for proxy in self._failure_list:
-            self._delete_or_decrease(
-                proxy,
-                client,
-                zset_key=zset_key
+            client.z_update_latency(
+                zset_key,
+                latencies,
+                failures,
+                window=self._latency_window,
+                chunk_size=self._batch_size
             )
-        for proxy in self._success_list:
-            self._insert_or_increase(
-                proxy,
-                client,
-                zset_key=zset_key
+        if self._schedule:
+            client.schedule_many(
+                self._name,
+                successes,
+                failures,
+                min_interval=self._min_interval,
+                max_interval=self._max_interval,
+                chunk_size=self._batch_size
             )
 
+    def _select(self, batch):
+        """
+        with schedule on, proxies not yet due are skipped this round.
+        """
+        batch = super(Verifier, self)._select(batch)
+        if self._schedule and batch:
+            batch = self._get_client(self._to_db).filter_due(self._name, batch)
+        return batch
+
+    async def select(self, batch):
+        if not self._async_client:
+            return await super(Verifier, self).select(batch)
+        batch = super(Verifier, self)._select(batch)
+        if self._schedule and batch:
+            batch = await self._get_aio_client(self._to_db).filter_due(self._name, batch)
+        return batch
+
+    def _get_client(self, db):
+        """
+        clients are cached per db, so verifiers sharing self._clients share connection pools.
+        """
+        if db not in self._clients:
+            params = {
+                'host': self._redis_host,
+                'port': self._redis_port,
+                'db': db,
+                'password': self._password,
+                'layout': self._layout
+            }
+            self._clients[db] = RedisPool(**params)
+        return self._clients[db]
+
+    def _get_aio_client(self, db):
+        """
+        AsyncRedisPool per db, cached in self._aio_clients like _get_client.
+        """
+        if db not in self._aio_clients:
+            from nproxypool.base.aio_db import AsyncRedisPool
+            self._aio_clients[db] = AsyncRedisPool(
+                host=self._redis_host,
+                port=self._redis_port,
+                db=db,
+                password=self._password,
+                layout=self._layout
+            )
+        return self._aio_clients[db]
+
+    def _get_pool(self, db):
+        """
+        return: (client of db, write-back for it), async ones with async_client on
+        """
+        if self._async_client:
+            return self._get_aio_client(db), self._update_async
+        return self._get_client(db), self._update
+
     def _key_to_key_verify(self):
         """
         first-level pool to first-level pool update.
         """
-        params = {
-            'host': self._redis_host,
-            'port': self._redis_port,
-            'db': self._from_db,
-            'password': self._password
-        }
-        client = RedisPool(**params)
-        proxy_list = client.get_all()
-        if proxy_list:
-            self._loop.run_until_complete(self.verify(proxy_list))
-            self._update(client)
+        client, update = self._get_pool(self._from_db)
+        return (
+            partial(client.iter_all, count=self._scan_count),
+            partial(update, client)
+        )
 
     def _key_to_zset_verify(self):
         """
         first-level pool to second-level pool update.
         """
-        params1 = {
-            'host': self._redis_host,
-            'port': self._redis_port,
-            'db': self._from_db,
-            'password': self._password
-        }
-        params2 = {
-            'host': self._redis_host,
-            'port': self._redis_port,
-            'db': self._to_db,
-            'password': self._password
-        }
-        client1 = RedisPool(**params1)
-        client2 = RedisPool(**params2)
-        proxy_list = client1.get_all()
-        if proxy_list:
-            self._loop.run_until_complete(self.verify(proxy_list))
-            self._update(client2, zset_key=self._to_db_key)
+        client1, _ = self._get_pool(self._from_db)
+        client2, update = self._get_pool(self._to_db)
+        return (
+            partial(client1.iter_all, count=self._scan_count),
+            partial(update, client2, zset_key=self._to_db_key)
+        )
 
     def _zest_to_zset_verify(self):
         """
         second-level pool to second-level pool update.
         """
-        params = {
-            'host': self._redis_host,
-            'port': self._redis_port,
-            'db': self._from_db,
-            'password': self._password
-        }
-        client = RedisPool(**params)
-        proxy_list = client.z_get_all(self._from_db_key)
-        if proxy_list:
-            self._loop.run_until_complete(self.verify(proxy_list))
-            self._update(client, zset_key=self._to_db_key)
+        client, update = self._get_pool(self._from_db)
+        return (
+            partial(client.z_iter, self._from_db_key, count=self._scan_count),
+            partial(update, client, zset_key=self._to_db_key)
+        )
 
-    def run(self, **kwargs):
-        self.init_verifier(**kwargs)
-        self._failure_list = []
-        self._success_list = []
+    def prepare(self):
+        """
+        return: (source_id, make_source, on_results)
+            source_id: verifiers with the same source_id read the same proxies
+            make_source: callable returning a new iterator(async with async_client) of proxies to verify
+            on_results: callable(successes, failures, latencies) writing a batch of results back,
+                        a coroutine function with async_client
+        """
         if self._from_db == self._to_db and not self._is_from_db_zset:
-            self._key_to_key_verify()
+            make_source, on_results = self._key_to_key_verify()
         elif self._is_to_db_zset and not self._is_from_db_zset:
-            self._key_to_zset_verify()
+            make_source, on_results = self._key_to_zset_verify()
         else:
-            self._zest_to_zset_verify()
+            make_source, on_results = self._zest_to_zset_verify()
+        source_id = (self._from_db, self._is_from_db_zset, self._from_db_key if self._is_from_db_zset else '')
+        return source_id, make_source, on_results
 
+    async def _open_session(self):
+        return self._make_session()
 
-def run_verifier(**kwargs):
-    time_sleep = kwargs.get('to_sleep', 10)
-    _name = kwargs.get('name', 'Default')
-    _name = 'verifier_{}'.format(_name)
-    file_name = '{}.log'.format(_name)
-    file_dir = kwargs.get('log_file_path')
-    v_logger = get_logger(
+    def start(self, **kwargs):
+        """
+        set up the verifier once for all of its rounds: the loop of the verifier,
+        one session and one redis client per db are kept until close().
+        """
+        self.init_verifier(**kwargs)
+        _, self._make_source, self._on_results = self.prepare()
+        self._session = self._loop.run_until_complete(self._open_session())
+
+    def run_round(self):
+        """
+        return: stats of the round
+        """
+        _start = time.monotonic()
+        self._round = self._loop.create_task(self.verify(self._make_source(), self._on_results))
+        self._loop.run_until_complete(self._round)
+        self.record_round(round(time.monotonic() - _start, 2))
+        return self.get_stats()
+
+    def run(self, **kwargs):
+        """
+        a single round, everything is closed afterwards.
+        """
+        self.start(**kwargs)
+        try:
+            self.run_round()
+        finally:
+            self.close()
+
+    def close(self):
+        if not self._loop.is_closed():
+            if self._round is not None and not self._round.done():
+                # a round interrupted by SIGTERM: cancelling it stops its workers
+                # and lets the sink write back the results buffered so far
+                self._round.cancel()
+                self._loop.run_until_complete(asyncio.gather(self._round, return_exceptions=True))
+            for client in self._aio_clients.values():
+                self._loop.run_until_complete(client.close())
+        self._aio_clients.clear()
+        super(Verifier, self).close()
+        for client in self._clients.values():
+            client.close()
+        self._clients.clear()
+
+    def record_round(self, duration):
+        """
+        one summary line per round replaces the per-proxy lines of the debug level.
+        """
+        self._stats['duration'] = duration
+        stats = self.get_stats()
+        ROUNDS.inc(verifier=self._name)
+        ROUND_SECONDS.set(duration, verifier=self._name, shard=self._shard)
+        CONCURRENCY.set(stats['concurrency'], verifier=self._name, shard=self._shard)
+        self._logger.info(
+            f'<<<round of {self._name}-{self._shard}: probes: {stats["probes"]}, '
+            f'successes: {stats["successes"]}, timeouts: {stats["timeouts"]}, errors: {stats["errors"]}, '
+            f'other failures: {stats["failures"] - stats["timeouts"] - stats["errors"]}, '
+            f'mean latency: {stats["mean_latency"]}, duration: {duration}, '
+            f'probes/s: {stats["probes_per_second"]}, concurrency: {stats["concurrency"]}'
+        )
+
+    def get_stats(self):
+        """
+        stats of the last round
+        """
+        stats = dict(self._stats, name=self._name, shard=self._shard, shards=self._shards)
+        stats['concurrency'] = self._limiter.limit if self._limiter else self._max_worker
+        stats['probes_per_second'] = round(stats['probes'] / max(stats.get('duration', 0), 0.01), 2)
+        stats['mean_latency'] = round(stats.pop('latency') / stats['successes'], 3) if stats['successes'] else None
+        return stats
+
+
+def get_verifier_logger(name, file_dir, shard=0, shards=1, log_level='info'):
+    """
+    log_level: console level, debug adds a line per probe to the round summaries
+    """
+    _name = 'verifier_{}'.format(name) if shards <= 1 else 'verifier_{}_{}'.format(name, shard)
+    return get_logger(
         name=_name,
-        filename=file_name,
+        filename='{}.log'.format(_name),
         filedir=file_dir,
         level='warning',
-        back_count=7
+        back_count=7,
+        console_level=log_level,
+        queued=True
     )
-    while True:
-        try:
-            v = Verifier()
-            v._logger = v_logger
-            v.run(**kwargs)
-        except:
-            v_logger.error(str(traceback.format_exc()))
-        time.sleep(time_sleep)
+
+
+def run_verifier(**kwargs):
+    """
+    stats_queue: optional multiprocessing queue receiving the stats of every round
+    metrics: optional params of start_pusher
+    """
+    time_sleep = kwargs.get('to_sleep', 10)
+    stats_queue = kwargs.pop('stats_queue', None)
+    metrics = kwargs.pop('metrics', None)
+    if metrics:
+        start_pusher('verifier_{}_{}'.format(kwargs.get('name', 'Default'), kwargs.get('shard', 0)), **metrics)
+    v_logger = get_verifier_logger(
+        kwargs.get('name', 'Default'),
+        kwargs.get('log_file_path'),
+        shard=kwargs.get('shard', 0),
+        shards=kwargs.get('shards', 1),
+        log_level=kwargs.get('log_level', 'info')
+    )
+    # SIGTERM unwinds like SystemExit, so the verifier is closed on the way out
+    signal.signal(signal.SIGTERM, lambda sig_num, frame: sys.exit(0))
+    v = Verifier()
+    v._logger = v_logger
+    v.start(**kwargs)
+    try:
+        while True:
+            try:
+                stats = v.run_round()
+                if stats_queue is not None:
+                    stats_queue.put(stats)
+            except Exception:
+                v_logger.error(str(traceback.format_exc()))
+            time.sleep(time_sleep)
+    finally:
+        v.close()
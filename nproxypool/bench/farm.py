@@ -0,0 +1,101 @@
+# =============================================
+# fake proxy farm on loopback
+# ---------------------------------------------
+# one HTTP target and n HTTP proxies forwarding to it, served by one event
+# loop in a child process so the farm does not compete with the code under
+# test for the GIL. Each proxy adds a random latency, fails a share of its
+# requests with 502, and a share of the proxies are dead(a closed port).
+# ==============================================
+import random
+import socket
+import asyncio
+import aiohttp
+from aiohttp import web
+from multiprocessing import Process, Queue
+
+TARGET_BODY = b'<html><body>npool bench target</body></html>'
+
+
+def _free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+class ProxyFarm(object):
+    def __init__(self, proxies=200, latency=0.05, jitter=0.5, failure_rate=0.05, dead_rate=0.1, seed=0):
+        """
+        proxies: number of proxies, dead ones included
+        latency: mean latency in seconds added by a proxy, spread by +-jitter of it
+        failure_rate: share of requests a live proxy answers with 502
+        dead_rate: share of proxies whose port is closed
+        """
+        self._proxies = proxies
+        self._latency = latency
+        self._jitter = jitter
+        self._failure_rate = failure_rate
+        self._dead_rate = dead_rate
+        self._seed = seed
+        self._process = None
+        self.target_url = ''
+        self.live = []
+        self.dead = []
+
+    async def _serve(self, ready):
+        rnd = random.Random(self._seed)
+
+        async def target(request):
+            return web.Response(body=TARGET_BODY, content_type='text/html')
+
+        async def proxy(request):
+            await asyncio.sleep(self._latency * rnd.uniform(1 - self._jitter, 1 + self._jitter))
+            if rnd.random() < self._failure_rate:
+                return web.Response(status=502)
+            async with session.get(str(request.url)) as r:
+                return web.Response(body=await r.read(), status=r.status, content_type=r.content_type)
+
+        session = aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=0))
+        sites = []
+        target_app = web.Application()
+        target_app.router.add_route('*', '/{tail:.*}', target)
+        proxy_app = web.Application()
+        proxy_app.router.add_route('*', '/{tail:.*}', proxy)
+        runners = []
+        for app in (target_app, proxy_app):
+            runner = web.AppRunner(app, access_log=None)
+            await runner.setup()
+            runners.append(runner)
+        target_port = _free_port()
+        await web.TCPSite(runners[0], '127.0.0.1', target_port).start()
+        live, dead = [], []
+        for _ in range(self._proxies):
+            port = _free_port()
+            if rnd.random() < self._dead_rate:
+                dead.append('127.0.0.1:{}'.format(port))
+                continue
+            site = web.TCPSite(runners[1], '127.0.0.1', port)
+            await site.start()
+            sites.append(site)
+            live.append('127.0.0.1:{}'.format(port))
+        ready.put(('http://127.0.0.1:{}/'.format(target_port), live, dead))
+        await asyncio.Event().wait()
+
+    def _run(self, ready):
+        asyncio.run(self._serve(ready))
+
+    def start(self):
+        ready = Queue()
+        self._process = Process(target=self._run, args=(ready,), daemon=True)
+        self._process.start()
+        self.target_url, self.live, self.dead = ready.get(timeout=60)
+        return self
+
+    def stop(self):
+        if self._process is not None:
+            self._process.terminate()
+            self._process.join()
+            self._process = None
+
+    @property
+    def proxies(self):
+        return self.live + self.dead
@@ -0,0 +1,272 @@
+# =============================================
+# npool bench: end-to-end benchmark against a fake proxy farm
+# ---------------------------------------------
+# stages, each run with the real components on a local redis-server:
+#   ingest  fetcher ingestion of the farm's proxies(with duplicates)
+#   verify  a key-to-key round on first-level pool, then a key-to-zset round
+#   sync    a full synchronizer pass after a share of first-level pool expired
+#   api     /proxy/random/ of server.py served over HTTP, p50/p99 latency
+# Redis round trips of every stage are read from the metrics registry.
+# WARNING: the two given dbs are flushed.
+# ==============================================
+import sys
+import json
+import time
+import socket
+import asyncio
+import logging
+import argparse
+import platform
+import threading
+from http.client import HTTPConnection
+from concurrent.futures import ThreadPoolExecutor
+from werkzeug.serving import make_server
+from nproxypool.base import server
+from nproxypool.base.db import RedisPool, REDIS_ROUND_TRIPS
+from nproxypool.base.verifier import Verifier
+from nproxypool.base.synchronizer import Synchronizer
+from nproxypool.base.proxy_fetcher import AsyncProxyFetcherBase
+from nproxypool.bench.farm import ProxyFarm
+
+BENCH_KEY = 'bench'
+
+
+def _round_trips():
+    return {k: v for k, v in REDIS_ROUND_TRIPS.snapshot()['samples'].items()}
+
+
+def _round_trips_since(before):
+    after = _round_trips()
+    by_op = {}
+    for key, value in after.items():
+        diff = value - before.get(key, 0)
+        if diff:
+            by_op[dict(json.loads(key))['op']] = diff
+    return {'total': sum(by_op.values()), 'by_op': by_op}
+
+
+def _percentile(values, q):
+    values = sorted(values)
+    return values[min(int(len(values) * q), len(values) - 1)] if values else None
+
+
+class BenchFetcher(AsyncProxyFetcherBase):
+    def __init__(self, proxies=(), duplicate_rate=0.3, **kwargs):
+        super(BenchFetcher, self).__init__(**kwargs)
+        self._bench_proxies = list(proxies)
+        self._duplicate_rate = duplicate_rate
+
+    async def fetch(self):
+        proxies = self._bench_proxies
+        yield proxies
+        yield proxies[:int(len(proxies) * self._duplicate_rate)]
+
+
+class BenchSuite(object):
+    def __init__(self, args):
+        self._args = args
+        self._redis = {'host': args.host, 'port': args.port, 'password': args.password, 'layout': args.layout}
+        self._first = RedisPool(db=args.first_db, **self._redis)
+        self._second = RedisPool(db=args.second_db, **self._redis)
+        self._farm = None
+        self._logger = logging.getLogger('nproxypool.bench')
+        self._logger.setLevel(logging.WARNING)
+
+    def _verifier_kwargs(self, **kwargs):
+        args = self._args
+        res = dict(
+            self._redis,
+            name='bench',
+            url=self._farm.target_url,
+            max_worker=args.max_worker,
+            time_out=args.time_out,
+            from_db=args.first_db,
+            to_db=args.first_db,
+            probe_mode=args.probe_mode,
+            adaptive=args.adaptive,
+            async_client=args.async_client
+        )
+        res.update(kwargs)
+        return res
+
+    def run_ingest(self):
+        fetcher = BenchFetcher(self._farm.proxies, duplicate_rate=self._args.duplicate_rate,
+                               db=self._args.first_db, async_client=self._args.async_client, **self._redis)
+        before = _round_trips()
+        _start = time.monotonic()
+        counts = asyncio.run(fetcher.run_async())
+        wall = time.monotonic() - _start
+        return dict(counts, seconds=round(wall, 3), proxies_per_second=round(counts['proxies'] / wall, 1),
+                    redis_round_trips=_round_trips_since(before))
+
+    def _run_verifier(self, **kwargs):
+        v = Verifier()
+        v._logger = self._logger
+        before = _round_trips()
+        v.run(**self._verifier_kwargs(**kwargs))
+        stats = v.get_stats()
+        return {
+            'probes': stats['probes'],
+            'successes': stats['successes'],
+            'failures': stats['failures'],
+            'round_seconds': stats['duration'],
+            'probes_per_second': stats['probes_per_second'],
+            'concurrency': stats['concurrency'],
+            'redis_round_trips': _round_trips_since(before)
+        }
+
+    def run_verify(self):
+        return {
+            'key_to_key': self._run_verifier(),
+            'key_to_zset': self._run_verifier(to_db=self._args.second_db, is_to_db_zset=True, to_db_key=BENCH_KEY)
+        }
+
+    def run_sync(self):
+        live = [p for p in self._first.iter_all()]
+        expired = live[:int(len(live) * self._args.expire_rate)]
+        for proxy in expired:
+            self._first.delete_one(proxy)
+        before = _round_trips()
+        _start = time.monotonic()
+        Synchronizer().synchronize(
+            first_db=self._args.first_db,
+            second_db=self._args.second_db,
+            second_db_keys=[BENCH_KEY],
+            **self._redis
+        )
+        res = {
+            'first_level': len(live) - len(expired),
+            'expired': len(expired),
+            'seconds': round(time.monotonic() - _start, 3),
+            'redis_round_trips': _round_trips_since(before)
+        }
+        res['second_level_after'] = self._second.z_get_total_num(BENCH_KEY)
+        return res
+
+    def run_api(self):
+        args = self._args
+        server.POOL = self._second
+        server.MAX_BATCH = 100
+        server.KEYS = frozenset([BENCH_KEY])
+        app = server.create_app()
+        logging.getLogger('werkzeug').setLevel(logging.WARNING)
+        with socket.socket() as s:
+            s.bind(('127.0.0.1', 0))
+            port = s.getsockname()[1]
+        httpd = make_server('127.0.0.1', port, app, threaded=True)
+        t = threading.Thread(target=httpd.serve_forever, daemon=True)
+        t.start()
+        paths = ['/proxy/random/?key={}'.format(BENCH_KEY), '/proxy/random/?key={}&n=10'.format(BENCH_KEY)]
+
+        def _client(n):
+            conn = HTTPConnection('127.0.0.1', port)
+            latencies = {path: [] for path in paths}
+            for i in range(n):
+                path = paths[i % len(paths)]
+                _start = time.monotonic()
+                conn.request('GET', path)
+                conn.getresponse().read()
+                latencies[path].append(time.monotonic() - _start)
+            conn.close()
+            return latencies
+
+        before = _round_trips()
+        _start = time.monotonic()
+        per_client = args.requests // args.api_concurrency
+        with ThreadPoolExecutor(args.api_concurrency) as executor:
+            results = list(executor.map(_client, [per_client] * args.api_concurrency))
+        wall = time.monotonic() - _start
+        httpd.shutdown()
+        res = {
+            'requests': per_client * args.api_concurrency,
+            'concurrency': args.api_concurrency,
+            'requests_per_second': round(per_client * args.api_concurrency / wall, 1),
+            'redis_round_trips': _round_trips_since(before)
+        }
+        for path in paths:
+            latencies = [x for r in results for x in r[path]]
+            res[path] = {
+                'p50_ms': round(_percentile(latencies, 0.5) * 1000, 3),
+                'p99_ms': round(_percentile(latencies, 0.99) * 1000, 3)
+            }
+        return res
+
+    def run(self):
+        args = self._args
+        self._first._client.flushdb()
+        self._second._client.flushdb()
+        self._farm = ProxyFarm(
+            proxies=args.proxies,
+            latency=args.latency,
+            failure_rate=args.failure_rate,
+            dead_rate=args.dead_rate,
+            seed=args.seed
+        ).start()
+        try:
+            results = {}
+            for stage in args.stages:
+                results[stage] = getattr(self, 'run_{}'.format(stage))()
+                print('{:<8} {}'.format(stage, json.dumps(results[stage])))
+        finally:
+            self._farm.stop()
+        return {
+            'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'environment': {
+                'nproxypool': _version(),
+                'python': platform.python_version(),
+                'platform': platform.platform(),
+                'redis': self._first._client.info('server').get('redis_version')
+            },
+            'params': {k: v for k, v in vars(args).items() if k not in ('password', 'output')},
+            'results': results
+        }
+
+
+def _version():
+    try:
+        from importlib.metadata import version
+        return version('nproxypool')
+    except Exception:
+        return 'unknown'
+
+
+def get_parser():
+    parser = argparse.ArgumentParser(prog='npool bench', description='benchmark against a local fake proxy farm')
+    parser.add_argument('--host', default='localhost')
+    parser.add_argument('--port', type=int, default=6379)
+    parser.add_argument('--password', default='')
+    parser.add_argument('--first-db', type=int, default=14)
+    parser.add_argument('--second-db', type=int, default=15)
+    parser.add_argument('--layout', default='string', choices=('string', 'packed'))
+    parser.add_argument('--stages', nargs='+', default=['ingest', 'verify', 'sync', 'api'],
+                        choices=('ingest', 'verify', 'sync', 'api'))
+    parser.add_argument('--proxies', type=int, default=1000)
+    parser.add_argument('--latency', type=float, default=0.05, help='mean latency of a proxy in seconds')
+    parser.add_argument('--failure-rate', type=float, default=0.05)
+    parser.add_argument('--dead-rate', type=float, default=0.1)
+    parser.add_argument('--duplicate-rate', type=float, default=0.3)
+    parser.add_argument('--expire-rate', type=float, default=0.1)
+    parser.add_argument('--max-worker', type=int, default=100)
+    parser.add_argument('--time-out', type=float, default=2)
+    parser.add_argument('--probe-mode', default='full', choices=('full', 'status', 'head', 'bytes'))
+    parser.add_argument('--adaptive', action='store_true')
+    parser.add_argument('--async-client', action='store_true', help='verifier and fetcher on AsyncRedisPool')
+    parser.add_argument('--requests', type=int, default=5000)
+    parser.add_argument('--api-concurrency', type=int, default=8)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', default='', help='json file, npool-bench-<time>.json by default')
+    return parser
+
+
+def main(argv=None):
+    args = get_parser().parse_args(argv)
+    print('WARNING: db {} and {} are flushed'.format(args.first_db, args.second_db))
+    report = BenchSuite(args).run()
+    output = args.output or 'npool-bench-{}.json'.format(time.strftime('%Y%m%d-%H%M%S'))
+    with open(output, 'w') as f:
+        json.dump(report, f, indent=2)
+    print('results written to {}'.format(output))
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
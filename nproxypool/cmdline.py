@@ -1,6 +1,6 @@
 import os
 import sys
-from nproxypool.utils.run import run_pool, run_server, run_generate
+from nproxypool.utils.run import run_pool, run_server, run_generate, run_migrate
 
 
 def show_usage():
@@ -8,6 +8,9 @@ def show_usage():
     print('mypool gen:        to generate a new proxypool project.')
     print('mypool run_pool:   to run the proxypool.')
     print('mypool run_server: to run server for the proxypool.')
+    print('mypool run_server async: to run the async(ASGI) server for the proxypool.')
+    print('mypool migrate <packed|string>: to convert first-level pool to another layout.')
+    print('mypool bench [options]: to benchmark the pool against a local fake proxy farm, see mypool bench -h.')
     sys.exit(1)
 
 
@@ -26,6 +29,12 @@ def execute():
     elif cmdname == 'run_pool':
         run_pool(dir)
     elif cmdname == 'run_server':
-        run_server(dir)
+        mode = args[1] if len(args) > 1 else None
+        run_server(dir, mode=mode)
+    elif cmdname == 'migrate' and len(args) > 1:
+        run_migrate(dir, args[1])
+    elif cmdname == 'bench':
+        from nproxypool.bench.suite import main
+        main(args[1:])
     else:
         show_usage()
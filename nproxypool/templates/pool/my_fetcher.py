@@ -1,34 +1,28 @@
-import requests
 from scrapy import Selector
 from urllib.parse import urljoin
-from user_agent import generate_user_agent
-from nproxypool.base.proxy_fetcher import ProxyFetcherBase
+from nproxypool.base.proxy_fetcher import AsyncProxyFetcherBase
 
 
-class ProxyFetcherIhuan(ProxyFetcherBase):
+class ProxyFetcherIhuan(AsyncProxyFetcherBase):
     def __init__(self, **kwargs):
         super(ProxyFetcherIhuan, self).__init__(**kwargs)
         self._url = 'https://ip.ihuan.me/'
-        self._user_agent = generate_user_agent(os='win')
 
-    def run(self):
-        headers = {
-            'user-agent': self._user_agent
-        }
-        r = requests.get(self._url, headers=headers)
-        s = Selector(text=r.text)
+    async def fetch(self):
+        s = Selector(text=await self.get(self._url))
         page_list = s.xpath('//ul[@class="pagination"]//a/@href').extract()
-        for _url in page_list:
-            url = urljoin(self._url, _url)
-            r = requests.get(url, headers=headers)
-            s = Selector(text=r.text)
-            labels = s.xpath('//div[@class="table-responsive"]//tr')
-            for tr in labels:
+        urls = [urljoin(self._url, _url) for _url in page_list]
+        async for url, text in self.get_many(urls):
+            if isinstance(text, Exception):
+                continue
+            s = Selector(text=text)
+            proxies = []
+            for tr in s.xpath('//div[@class="table-responsive"]//tr'):
                 ip = tr.xpath('./td[1]/a/text()').get()
                 port = tr.xpath('./td[2]/text()').get()
                 if ip and port:
-                    proxy = f'{ip}:{port}'
-                    self._client.insert_one(proxy)
+                    proxies.append(f'{ip}:{port}')
+            yield proxies
 
 
 if __name__ == '__main__':
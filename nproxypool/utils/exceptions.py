@@ -14,3 +14,32 @@ class NotInProject(Exception):
 
     def __str__(self):
         return repr('Please execute this command in a proxypool project.')
+
+
+class StatusCodeError(Exception):
+
+    def __init__(self, status):
+        Exception.__init__(self)
+        self.status = status
+
+    def __str__(self):
+        return repr('!STATUS CODE ERROR!: {}'.format(self.status))
+
+
+class ProbeAssertionError(Exception):
+
+    def __init__(self):
+        Exception.__init__(self)
+
+    def __str__(self):
+        return repr('Probe content assertion failed.')
+
+
+class MissingAsyncExtra(Exception):
+
+    def __init__(self, option):
+        Exception.__init__(self)
+        self.option = option
+
+    def __str__(self):
+        return repr('{} requires: pip install nproxypool[async]'.format(self.option))
@@ -3,7 +3,7 @@ from configparser import ConfigParser
 from stat import S_IWUSR as OWNER_WRITE_PERMISSION
 from shutil import ignore_patterns, copy2, copystat
 import gunicorn.app.base
-from nproxypool.utils.exceptions import NotInProject
+from nproxypool.utils.exceptions import NotInProject, MissingAsyncExtra
 
 
 IGNORE = ignore_patterns('*.pyc', '__pycache__', '.svn')
@@ -66,12 +66,44 @@ def get_gunicorn_config(dir):
     return g_conf
 
 
+def get_server_config(dir):
+    config = get_config_object(dir)
+    conf_server = dict()
+    section = 'server'
+    conf_server['mode'] = config.get(section, 'mode', fallback='sync')
+    conf_server['max_connections'] = config.getint(section, 'max_connections', fallback=100)
+    conf_server['max_batch'] = config.getint(section, 'max_batch', fallback=100)
+    conf_server['cache'] = config.getboolean(section, 'cache', fallback=False)
+    conf_server['cache_options'] = dict(
+        ttl=config.getfloat(section, 'cache_ttl', fallback=5),
+        max_keys=config.getint(section, 'cache_max_keys', fallback=64),
+        check_interval=config.getfloat(section, 'cache_check_interval', fallback=1),
+        flush_interval=config.getfloat(section, 'cache_flush_interval', fallback=1)
+    )
+    return conf_server
+
+
+def get_engine_config(dir):
+    config = get_config_object(dir)
+    conf_engine = dict()
+    conf_engine['mode'] = config.get('engine', 'mode', fallback='process')
+    return conf_engine
+
+
 def get_redis_config(dir):
     config = get_config_object(dir)
     conf_redis = dict()
     conf_redis['host'] = config.get('redis', 'host')
     conf_redis['port'] = config.getint('redis', 'port')
     conf_redis['password'] = config.get('redis', 'password')
+    conf_redis['layout'] = config.get('redis', 'layout', fallback='string')
+    conf_redis['async_client'] = config.getboolean('redis', 'async_client', fallback=False)
+    if conf_redis['async_client']:
+        # redis.asyncio comes with redis>=4.2.0, only required by the async extra
+        try:
+            import redis.asyncio
+        except ImportError:
+            raise MissingAsyncExtra('async_client')
     return conf_redis
 
 
@@ -95,7 +127,9 @@ def get_verifier_config(dir):
     conf_list = []
     opt_bool = (
         'is_from_db_zset',
-        'is_to_db_zset'
+        'is_to_db_zset',
+        'adaptive',
+        'schedule'
     )
     opt_int = (
         'from_db',
@@ -104,11 +138,26 @@ def get_verifier_config(dir):
         'score_decrease_by',
         'time_out',
         'to_sleep',
-        'max_worker'
+        'max_worker',
+        'conn_limit',
+        'conn_limit_per_host',
+        'dns_cache_ttl',
+        'keepalive_timeout',
+        'batch_size',
+        'scan_count',
+        'queue_size',
+        'flush_size',
+        'flush_interval',
+        'shards',
+        'min_worker',
+        'probe_max_bytes',
+        'min_interval',
+        'max_interval',
+        'latency_window'
     )
     for section in config.sections():
         s = dict()
-        if section in ('redis',):
+        if 'verifier' not in section:
             continue
         for opt in config.options(section):
             if opt in opt_bool:
@@ -133,6 +182,10 @@ def get_sychronizer_config(dir):
             conf_sync['first_db'] = config.getint(section, 'from_db')
         elif 'sync' in section:
             conf_sync['to_sleep'] = config.getint(section, 'to_sleep')
+            conf_sync['scan_count'] = config.getint(section, 'scan_count', fallback=1000)
+            conf_sync['chunk_size'] = config.getint(section, 'chunk_size', fallback=500)
+            conf_sync['mode'] = config.get(section, 'mode', fallback='poll')
+            conf_sync['full_sync_to_sleep'] = config.getint(section, 'full_sync_to_sleep', fallback=3600)
         elif 'verifier' in section:
             conf_sync['second_db'] = config.getint(section, 'to_db')
             second_db_keys.append(config.get(section, 'to_db_key'))
@@ -142,10 +195,31 @@ def get_sychronizer_config(dir):
     return conf_sync
 
 
+def get_metrics_config(dir):
+    """
+    return: params of start_pusher(redis params of second-level pool and push interval),
+            None if metrics are disabled, as they are in a pool.cfg without [metrics]
+    """
+    config = get_config_object(dir)
+    if not config.getboolean('metrics', 'enabled', fallback=False):
+        return None
+    conf_metrics = get_redis_config(dir)
+    conf_metrics['db'] = get_sychronizer_config(dir)['second_db']
+    conf_metrics['interval'] = config.getint('metrics', 'push_interval', fallback=10)
+    return conf_metrics
+
+
 def get_fetcher_config(dir):
     config = get_config_object(dir)
     conf_fetcher = dict()
     conf_fetcher['to_sleep'] = config.getint('fetcher', 'to_sleep')
+    conf_fetcher['max_fetchers'] = config.getint('fetcher', 'max_fetchers', fallback=4)
+    conf_fetcher['jitter'] = config.getfloat('fetcher', 'jitter', fallback=0.1)
+    conf_fetcher['timeout'] = config.getint('fetcher', 'timeout', fallback=300)
+    conf_fetcher['max_backoff'] = config.getint('fetcher', 'max_backoff', fallback=3600)
+    conf_fetcher['report_interval'] = config.getint('fetcher', 'report_interval', fallback=300)
+    conf_fetcher['seen_ttl'] = config.getint('fetcher', 'seen_ttl', fallback=0)
+    conf_fetcher['seen_capacity'] = config.getint('fetcher', 'seen_capacity', fallback=100000)
     for section in config.sections():
         if 'init' in section:
             conf_fetcher['db'] = config.getint(section, 'from_db')
@@ -9,24 +9,43 @@ import signal
 import traceback
 import importlib
 from copy import deepcopy
-from multiprocessing import Process
+from multiprocessing import Process, Queue, active_children
 from werkzeug.debug import DebuggedApplication
 from nproxypool.base.verifier import run_verifier
+from nproxypool.base.engine import run_engine
 from nproxypool.base.synchronizer import sync
-from nproxypool.base.proxy_fetcher import ProxyFetcherBase
+from nproxypool.base.proxy_fetcher import ProxyFetcherBase, AsyncProxyFetcherBase
+from nproxypool.base.scheduler import FetcherScheduler
+from nproxypool.base.metrics import start_pusher, disable_instrumentation
 from nproxypool.utils.misc import get_redis_config, get_verifier_config
 from nproxypool.utils.misc import get_sychronizer_config, get_fetcher_config
-from nproxypool.utils.misc import get_logfile_dir, get_gunicorn_config
+from nproxypool.utils.misc import get_logfile_dir, get_gunicorn_config, get_server_config
+from nproxypool.utils.misc import get_engine_config, get_fetcher_insert_db, get_metrics_config
+from nproxypool.base.db import RedisPool
 from nproxypool.utils.misc import GunicornStandalone
 from nproxypool.base.server import make_app
 from nproxypool.base.logger import get_logger
+from nproxypool.base.stats import ShardStats
 from nproxypool.utils.misc import copytree
 
 
+# seconds subprocesses are given to clean up after SIGTERM, before they are killed
+TERM_TIMEOUT = 10
+
+
 # close subprocess when parent process is closed
 def term(sig_num, addtion):
     print('term current pid is %s, group id is %s' % (os.getpid(), os.getpgrp()))
-    os.killpg(os.getpgid(os.getpid()), signal.SIGKILL)
+    children = active_children()
+    for child in children:
+        child.terminate()
+    deadline = time.monotonic() + TERM_TIMEOUT
+    for child in children:
+        child.join(max(deadline - time.monotonic(), 0))
+        if child.is_alive():
+            child.kill()
+            child.join()
+    sys.exit(0)
 
 
 signal.signal(signal.SIGTERM, term)
@@ -42,17 +61,22 @@ def run_fetcher(**kwargs):
         level='warning',
         back_count=7
     )
-    to_sleep = kwargs.get('to_sleep', 30)
+    metrics = kwargs.pop('metrics', None)
+    if metrics:
+        start_pusher('fetcher', **metrics)
+    max_fetchers = kwargs.pop('max_fetchers', 4)
+    report_interval = kwargs.pop('report_interval', 300)
     fetcher_module = importlib.import_module('my_fetcher')
+    fetchers = []
     for attr in dir(fetcher_module):
         v = getattr(fetcher_module, attr)
-        if type(v).__name__ == 'type' and issubclass(v, ProxyFetcherBase) and attr != 'ProxyFetcherBase':
+        if type(v).__name__ == 'type' and issubclass(v, ProxyFetcherBase) \
+                and v not in (ProxyFetcherBase, AsyncProxyFetcherBase):
             try:
-                fetcher = v(**kwargs)
-                fetcher.run()
+                fetchers.append(v(**kwargs))
             except:
                 logger.error(str(traceback.format_exc()))
-    time.sleep(to_sleep)
+    FetcherScheduler(fetchers, logger, max_fetchers=max_fetchers, report_interval=report_interval).run()
 
 
 def run_pool(dir):
@@ -63,54 +87,116 @@ def run_pool(dir):
         sys.path.append(dir)
     redis_params = get_redis_config(dir)
     log_file_dir = get_logfile_dir(dir)
+    # every process pushes its metrics for /metrics of the server
+    metrics = get_metrics_config(dir)
+    if metrics is None:
+        # inherited by the processes forked below
+        disable_instrumentation()
 
     # fetcher process
     kwargs_fetcher = get_fetcher_config(dir)
     kwargs_fetcher.update(redis_params)
     kwargs_fetcher['log_file_path'] = log_file_dir
+    kwargs_fetcher['metrics'] = metrics
     p = Process(target=run_fetcher, kwargs=kwargs_fetcher)
     p.daemon = True
     p.start()
 
     # verifier processes
     verifier_conf_list = get_verifier_config(dir)
+    kwargs_v_list = []
     for verifier_conf in verifier_conf_list:
         kwargs_v = deepcopy(verifier_conf)
         kwargs_v.update(redis_params)
         kwargs_v['log_file_path'] = log_file_dir
-        t = Process(target=run_verifier, kwargs=kwargs_v)
+        kwargs_v['metrics'] = metrics
+        kwargs_v_list.append(kwargs_v)
+    stats_queue = None
+    if get_engine_config(dir)['mode'] == 'multiplex':
+        t = Process(
+            target=run_engine,
+            kwargs=dict(conf_list=kwargs_v_list, log_file_path=log_file_dir, metrics=metrics)
+        )
         t.daemon = True
         t.start()
+    else:
+        # each verifier runs `shards` processes, each owning a hash partition of the proxies
+        stats_queue = Queue()
+        for kwargs_v in kwargs_v_list:
+            for shard in range(kwargs_v.get('shards', 1)):
+                kwargs_shard = dict(kwargs_v, shard=shard, stats_queue=stats_queue)
+                t = Process(target=run_verifier, kwargs=kwargs_shard)
+                t.daemon = True
+                t.start()
 
     # synchronizer process
     kwargs_sync = get_sychronizer_config(dir)
     kwargs_sync['log_file_path'] = log_file_dir
+    kwargs_sync['metrics'] = metrics
     p1 = Process(target=sync, kwargs=kwargs_sync)
     p1.daemon = True
     p1.start()
 
+    stats = ShardStats(get_logger(name='verifier_stats'))
     while True:
+        if stats_queue is not None:
+            stats.drain(stats_queue)
+            stats.report()
         time.sleep(1)
 
 
-def run_server(dir):
+def run_server(dir, mode=None):
+    """
+    mode: 'sync'(flask) or 'async'(ASGI), defaults to [server] mode in pool.cfg
+    """
     options = get_gunicorn_config(dir)
-    app = make_app(dir)
-    if options.get('debug'):
+    mode = mode or get_server_config(dir)['mode']
+    debug = str(options.pop('debug', '')).lower() in ('true', '1', 'yes')
+    if mode == 'async':
+        try:
+            from nproxypool.base.aio_server import make_app as make_asgi_app
+        except ImportError:
+            print('async server requires: pip install nproxypool[async]')
+            sys.exit(1)
+        app = make_asgi_app(dir)
+        app_name = 'nproxypool.base.aio_server'
+        options['worker_class'] = 'uvicorn.workers.UvicornWorker'
+    else:
+        app = make_app(dir)
+        app_name = app.import_name
+    if debug:
         options["workers"] = 1
-        app.wsgi_app = DebuggedApplication(app.wsgi_app, True)
+        if mode != 'async':
+            app.wsgi_app = DebuggedApplication(app.wsgi_app, True)
         print(' * Launching in DEBUG mode')
-        print(' * Serving Flask using a single worker "{}"'.format(app.import_name))
-        options["reload"] = bool(options['debug'])
+        print(' * Serving {} using a single worker "{}"'.format(mode, app_name))
+        options["reload"] = True
     else:
         print(' * Launching in Production Mode')
-        print(' * Serving Flask with {} worker(s) "{}"'.format(
-            options["workers"], app.import_name
+        print(' * Serving {} with {} worker(s) "{}"'.format(
+            mode, options["workers"], app_name
         ))
     server = GunicornStandalone(app, options=options)
     server.run()
 
 
+def run_migrate(dir, layout):
+    """
+    convert first-level pool to layout('packed' or 'string'), set the same layout in [redis] afterwards.
+    """
+    if layout not in ('packed', 'string'):
+        print('layout must be packed or string')
+        sys.exit(1)
+    params = get_redis_config(dir)
+    params.update(get_fetcher_insert_db(dir))
+    pool = RedisPool(**params)
+    _start = time.monotonic()
+    migrated = pool.migrate_layout(layout)
+    print('{} proxies converted to the {} layout in {:.2f}s'.format(migrated, layout, time.monotonic() - _start))
+    if params['layout'] != layout:
+        print('now set layout = {} in [redis] of pool.cfg'.format(layout))
+
+
 def run_generate(dir, name='proxypool'):
     tempfile_path = os.path.join(
         os.path.dirname(nproxypool.__file__),
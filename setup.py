@@ -32,7 +32,13 @@ setup(
     entry_points={
         'console_scripts': ['npool = nproxypool.cmdline:execute']
     },
-    python_requires='>=3.6',
+    python_requires='>=3.7',
     install_requires=install_requires,
-    extras_require={}
+    extras_require={
+        'async': [
+            'redis>=4.2.0',
+            'starlette>=0.26.0',
+            'uvicorn>=0.13.0'
+        ]
+    }
 )
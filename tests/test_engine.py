@@ -0,0 +1,14 @@
+import zlib
+from nproxypool.base.engine import VerifierEngine
+
+
+def test_engine_ignores_shards():
+    engine = VerifierEngine()
+    conf = {'name': 'test', 'host': 'localhost', 'port': 6379, 'password': '', 'shards': 4, 'shard': 1}
+    engine.init_engine([conf])
+    try:
+        batch = ['10.0.0.{}:8080'.format(i) for i in range(100)]
+        assert len({zlib.crc32(p.encode()) % 4 for p in batch}) == 4
+        assert engine._targets[0]['verifier']._select(batch) == batch
+    finally:
+        engine.close()